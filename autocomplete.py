@@ -0,0 +1,110 @@
+import bisect
+import heapq
+from collections import OrderedDict
+
+# === Hashtag autocomplete ===
+# Inline queries (@bot #ho...) are answered from a TagDictionary: every tag in
+# a collection, kept in a sorted array with the number of videos carrying it.
+# The tags starting with a prefix are one bisect away; ranking them by count
+# is what costs, so the best ones are cached per prefix and kept up to date as
+# counts change instead of being dropped on every mutation.
+#
+# A cached entry holds the exact counts of some of the prefix's tags (at most
+# 2 * CACHE_DEPTH of them) and a floor: every tag with the prefix that is not
+# in the entry has at most floor videos. A tag whose count changes is updated
+# in the entries of each of its prefixes, and joins one once its count rises
+# above the floor. An entry can answer for the top k as long as its k-th best
+# count is at least the floor (ties may come out in either order); otherwise
+# it is recomputed from the sorted array.
+
+CACHE_DEPTH = 20
+PREFIX_CACHE_SIZE = 4096
+
+
+class PrefixEntry:
+    __slots__ = ("counts", "floor")
+
+    def __init__(self, counts, floor):
+        self.counts = counts
+        self.floor = floor
+
+    def top(self, limit):
+        best = heapq.nsmallest(limit, self.counts.items(), key=lambda item: (-item[1], item[0]))
+        if len(best) < limit:
+            return best if self.floor == 0 else None
+        return best if best[-1][1] >= self.floor else None
+
+    def update(self, tag, count):
+        if tag in self.counts:
+            if count:
+                self.counts[tag] = count
+            else:
+                del self.counts[tag]
+        elif count > self.floor:
+            self.counts[tag] = count
+            if len(self.counts) > 2 * CACHE_DEPTH:
+                dropped = min(self.counts, key=self.counts.get)
+                self.floor = max(self.floor, self.counts.pop(dropped))
+
+
+class TagDictionary:
+    def __init__(self, counts=None):
+        # tag -> number of videos; names is every tag with a count, sorted.
+        self.counts = dict(counts or {})
+        self.names = sorted(self.counts)
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, tags):
+        for tag in tags:
+            count = self.counts.get(tag, 0) + 1
+            if count == 1:
+                bisect.insort(self.names, tag)
+            self.counts[tag] = count
+            self._changed(tag, count)
+
+    def remove(self, tags):
+        for tag in tags:
+            count = self.counts[tag] - 1
+            if count:
+                self.counts[tag] = count
+            else:
+                del self.counts[tag]
+                del self.names[bisect.bisect_left(self.names, tag)]
+            self._changed(tag, count)
+
+    def _changed(self, tag, count):
+        for end in range(1, len(tag) + 1):
+            entry = self._cache.get(tag[:end])
+            if entry is not None:
+                entry.update(tag, count)
+
+    def complete(self, prefix, limit=10):
+        # The limit most used tags starting with prefix, as (tag, count)
+        # pairs, most used first.
+        limit = min(limit, CACHE_DEPTH)
+        entry = self._cache.get(prefix)
+        if entry is not None:
+            self._cache.move_to_end(prefix)
+            best = entry.top(limit)
+            if best is not None:
+                return best
+        entry = self._cache[prefix] = self._compute(prefix)
+        self._cache.move_to_end(prefix)
+        while len(self._cache) > PREFIX_CACHE_SIZE:
+            self._cache.popitem(last=False)
+        return entry.top(limit)
+
+    def _compute(self, prefix):
+        names = self.names
+        counts = self.counts
+        lo = bisect.bisect_left(names, prefix)
+        hi = bisect.bisect_left(names, prefix + "\U0010ffff")
+        if hi - lo <= 2 * CACHE_DEPTH:
+            return PrefixEntry({names[i]: counts[names[i]] for i in range(lo, hi)}, 0)
+        best = heapq.nlargest(2 * CACHE_DEPTH + 1, names[lo:hi], key=counts.__getitem__)
+        # The first one left out bounds everything else.
+        floor = counts[best.pop()]
+        return PrefixEntry({name: counts[name] for name in best}, floor)
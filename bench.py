@@ -0,0 +1,377 @@
+import os
+import sys
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import types
+
+# === Offline benchmark ===
+# Builds synthetic collections of 10k-1M videos and drives bot.py's handlers
+# through fake Update/Context objects whose reply_text only records the text,
+# so no token or network is needed. For every storage backend, corpus size and
+# operation it reports p50/p99 latency, throughput, peak Python memory and
+# bytes written per operation, and saves the results as JSON:
+#
+#   python bench.py --sizes 10000,100000 --backend sqlite --out before.json
+#   python bench.py --sizes 10000,100000 --backend sqlite --compare before.json
+#
+# --compare prints the change against an earlier run and exits with status 1
+# if any p50 or p99 got slower by more than --threshold.
+
+CHAT_ID = 1
+SEED_BATCH_SIZE = 10_000
+MEMORY_SAMPLE_OPS = 20
+
+# Rough shape of real collections: most videos carry a city and a category
+# tag, and free tags follow a Zipf-like distribution over a large vocabulary.
+CITY_WEIGHTS = {"#gz": 55, "#sz": 30, None: 15}
+CATEGORY_WEIGHTS = {"#toeat": 50, "#toexplore": 30, "#tobuy": 12, None: 8}
+FREE_TAG_COUNT_WEIGHTS = {0: 15, 1: 35, 2: 30, 3: 15, 4: 5}
+FREE_TAG_VOCABULARY = 2000
+
+
+# === Synthetic corpus ===
+class CorpusGenerator:
+    def __init__(self, seed):
+        self.rng = random.Random(seed)
+        self.next_id = 7_000_000_000_000_000_000
+        self.free_tags = [f"#tag{i}" for i in range(FREE_TAG_VOCABULARY)]
+        self.free_tag_weights = list(itertools.accumulate(1 / (i + 1) for i in range(FREE_TAG_VOCABULARY)))
+
+    def _pick(self, weights):
+        return self.rng.choices(list(weights), weights=list(weights.values()))[0]
+
+    def free_tag(self):
+        return self.rng.choices(self.free_tags, cum_weights=self.free_tag_weights)[0]
+
+    def hashtags(self):
+        tags = [self._pick(CITY_WEIGHTS), self._pick(CATEGORY_WEIGHTS)]
+        tags = [tag for tag in tags if tag]
+        for _ in range(self._pick(FREE_TAG_COUNT_WEIGHTS)):
+            tag = self.free_tag()
+            if tag not in tags:
+                tags.append(tag)
+        self.rng.shuffle(tags)
+        return tags
+
+    def url(self):
+        self.next_id += 1
+        return f"https://www.tiktok.com/@user{self.rng.randrange(5000)}/video/{self.next_id}"
+
+    def video(self):
+        return {"url": self.url(), "hashtags": self.hashtags()}
+
+    def message(self):
+        return " ".join([self.url()] + self.hashtags())
+
+    def query(self):
+        # A mix of broad, narrow and empty-result searches.
+        kind = self.rng.randrange(5)
+        if kind == 0:
+            return [self._pick({"#gz": 1, "#sz": 1})]
+        if kind == 1:
+            return ["#gz", self._pick({tag: w for tag, w in CATEGORY_WEIGHTS.items() if tag})]
+        if kind == 2:
+            return [self.free_tag()]
+        if kind == 3:
+            return [self.free_tag(), self._pick({"#gz": 1, "#sz": 1})]
+        return [f"#tag{FREE_TAG_VOCABULARY - 1 - self.rng.randrange(100)}", "#tobuy"]
+
+
+# === Fake Telegram objects ===
+class FakeMessage:
+    def __init__(self, text, chat_id):
+        self.text = text
+        self.caption = None
+        self.document = None
+        self.chat_id = chat_id
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+        return types.SimpleNamespace(message_id=len(self.replies), chat_id=self.chat_id)
+
+
+class FakeInlineQuery:
+    def __init__(self, text, user_id, replies):
+        self.query = text
+        self.from_user = types.SimpleNamespace(id=user_id)
+        self.replies = replies
+
+    async def answer(self, results, **kwargs):
+        self.replies.append(results)
+
+
+class FakeUpdate:
+    def __init__(self, text="", chat_id=CHAT_ID):
+        self.message = FakeMessage(text, chat_id)
+        self.inline_query = FakeInlineQuery(text, chat_id, self.message.replies)
+        self.effective_chat = types.SimpleNamespace(id=chat_id, type="private")
+        self.effective_user = types.SimpleNamespace(id=chat_id)
+        self.callback_query = None
+
+
+class FakeContext:
+    # user_data and chat_data outlive a single update, as they do in PTB.
+    def __init__(self, user_data, chat_data, args=None):
+        self.user_data = user_data
+        self.chat_data = chat_data
+        self.args = args or []
+        self.bot = None
+
+
+# === Measurement ===
+def bytes_written():
+    # wchar counts every byte passed to write(), including the writer threads'.
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+class Session:
+    def __init__(self, bot, gen):
+        self.bot = bot
+        self.gen = gen
+        self.user_data = {}
+        self.chat_data = {}
+
+    def context(self, args=None):
+        return FakeContext(self.user_data, self.chat_data, args)
+
+    async def call(self, handler, text="", args=None):
+        update = FakeUpdate(text)
+        await handler(update, self.context(args))
+        return update.message.replies
+
+    # Each op prepares its own state untimed, then returns the timed call.
+    def op_search(self):
+        args = self.gen.query()
+        return self.call(self.bot.search_videos, "/search " + " ".join(args), args)
+
+    def op_list(self):
+        return self.call(self.bot.list_videos, "/list")
+
+    def op_add(self):
+        self.user_data["expecting_video"] = {"chat_id": CHAT_ID}
+        return self.call(self.bot.handle_message, self.gen.message())
+
+    def op_edit(self):
+        store = self.bot.chat_store(FakeUpdate())
+        index = self.gen.rng.randrange(store.count())
+        video = store.get(index)
+        self.user_data["editing_video"] = {"chat_id": CHAT_ID, "id": video.id, "version": video.version, "number": index + 1}
+        return self.call(self.bot.handle_message, self.gen.message())
+
+    def op_delete(self):
+        index = self.gen.rng.randrange(self.bot.chat_store(FakeUpdate()).count()) + 1
+        return self.call(self.bot.deletevideo, f"/deletevideo {index}", [str(index)])
+
+    def op_inline(self):
+        # A tag being typed, after a city half the time.
+        prefix = self.gen.free_tag()[:self.gen.rng.randrange(1, 6)]
+        city = self.gen._pick({"#gz": 1, "#sz": 1, "": 2})
+        return self.call(self.bot.inline_query, f"{city} {prefix}".lstrip())
+
+
+OPERATIONS = ["search", "list", "inline", "add", "edit", "delete"]
+
+
+async def measure(session, op, n):
+    prepare = getattr(session, f"op_{op}")
+    store = session.bot.chat_store(FakeUpdate())
+    await store.flushed()
+
+    latencies = []
+    written_before = bytes_written()
+    started = time.perf_counter()
+    for _ in range(n):
+        call = prepare()
+        t0 = time.perf_counter()
+        replies = await call
+        latencies.append(time.perf_counter() - t0)
+        if not replies:
+            raise RuntimeError(f"{op} sent no reply")
+    elapsed = time.perf_counter() - started
+    await store.flushed()
+    written_after = bytes_written()
+
+    # A separate, shorter pass under tracemalloc, which would skew latencies.
+    tracemalloc.start()
+    for _ in range(min(n, MEMORY_SAMPLE_OPS)):
+        await prepare()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        "op": op,
+        "n": n,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "ops_per_sec": n / elapsed,
+        "peak_memory_bytes": peak,
+        "bytes_written_per_op": (written_after - written_before) / n if written_before is not None else None,
+    }
+
+
+async def seed(store, gen, size):
+    for start in range(0, size, SEED_BATCH_SIZE):
+        store.add_many([gen.video() for _ in range(min(SEED_BATCH_SIZE, size - start))])
+        await store.flushed()
+
+
+async def run_case(bot, ShardedStore, backend, size, n, seed_value):
+    gen = CorpusGenerator(seed_value)
+    with tempfile.TemporaryDirectory(prefix="bench-") as data_dir:
+        bot.shards = ShardedStore(backend, data_dir, max_videos=size + 10 * n)
+        started = time.perf_counter()
+        await seed(bot.chat_store(FakeUpdate()), gen, size)
+        seed_seconds = time.perf_counter() - started
+        bot.shards.close()
+
+        # Cold open of the seeded collection, then again under tracemalloc
+        # for its resident size.
+        bot.shards = ShardedStore(backend, data_dir, max_videos=size + 10 * n)
+        started = time.perf_counter()
+        bot.chat_store(FakeUpdate())
+        open_seconds = time.perf_counter() - started
+        bot.shards.close()
+        bot.shards = ShardedStore(backend, data_dir, max_videos=size + 10 * n)
+        tracemalloc.start()
+        bot.chat_store(FakeUpdate())
+        resident = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        results = [{
+            "op": "open",
+            "n": 1,
+            "p50_ms": open_seconds * 1000,
+            "p99_ms": open_seconds * 1000,
+            "ops_per_sec": 1 / open_seconds,
+            "peak_memory_bytes": resident,
+            "bytes_written_per_op": None,
+        }]
+        session = Session(bot, gen)
+        for op in OPERATIONS:
+            results.append(await measure(session, op, n))
+        bot.shards.close()
+
+    for result in results:
+        result.update(backend=backend, size=size)
+    logging.warning(f"{backend} {size}: seeded in {seed_seconds:.1f}s")
+    return results
+
+
+# === Reporting ===
+def result_key(result):
+    return (result["backend"], result["size"], result["op"])
+
+
+def print_results(results):
+    print(f"{'backend':8} {'size':>8} {'op':7} {'p50 ms':>9} {'p99 ms':>9} {'ops/s':>9} {'peak KiB':>10} {'B/op':>9}")
+    for r in results:
+        written = f"{r['bytes_written_per_op']:.0f}" if r["bytes_written_per_op"] is not None else "-"
+        print(
+            f"{r['backend']:8} {r['size']:>8} {r['op']:7} {r['p50_ms']:>9.3f} {r['p99_ms']:>9.3f} "
+            f"{r['ops_per_sec']:>9.0f} {r['peak_memory_bytes'] / 1024:>10.0f} {written:>9}"
+        )
+
+
+def compare(results, baseline_path, threshold):
+    with open(baseline_path) as f:
+        baseline = {result_key(r): r for r in json.load(f)["results"]}
+    regressions = 0
+    print(f"\nChange against {baseline_path}:")
+    for r in results:
+        before = baseline.get(result_key(r))
+        if before is None:
+            continue
+        changes = []
+        for metric in ("p50_ms", "p99_ms"):
+            ratio = r[metric] / before[metric] if before[metric] else 1
+            flag = ""
+            if ratio > 1 + threshold:
+                flag = " REGRESSION"
+                regressions += 1
+            changes.append(f"{metric} x{ratio:.2f}{flag}")
+        print(f"{r['backend']:8} {r['size']:>8} {r['op']:7} " + ", ".join(changes))
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the bot's handlers and storage offline.")
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="comma-separated corpus sizes")
+    parser.add_argument("--backend", choices=["json", "sqlite", "both"], default="both")
+    parser.add_argument("--ops", type=int, default=200, help="operations timed per handler")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", default=f"bench-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    parser.add_argument("--compare", help="results JSON of an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown before flagging, e.g. 0.2 = 20%%")
+    return parser.parse_args()
+
+
+async def main():
+    args = parse_args()
+    # bot.py opens its default store at import; keep that out of the way.
+    os.environ["DATA_DIR"] = tempfile.mkdtemp(prefix="bench-default-")
+    os.environ.pop("LEGACY_CHAT_ID", None)
+    import bot
+    from storage import ShardedStore
+    # bot.py imports telegram where it is first used; keep that out of the
+    # first timed call.
+    import telegram.constants  # noqa: F401
+    logging.getLogger().setLevel(logging.WARNING)
+    bot.shards.close()
+
+    backends = ["json", "sqlite"] if args.backend == "both" else [args.backend]
+    results = []
+    for backend in backends:
+        for size in (int(s) for s in args.sizes.split(",")):
+            results.extend(await run_case(bot, ShardedStore, backend, size, args.ops, args.seed))
+    shutil.rmtree(os.environ["DATA_DIR"])
+
+    print_results(results)
+    with open(args.out, "w") as f:
+        json.dump({
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": vars(args),
+            "max_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "results": results,
+        }, f, indent=2)
+    print(f"\nSaved results to {args.out}")
+
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    asyncio.run(main())
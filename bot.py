@@ -1,29 +1,323 @@
+from __future__ import annotations
+import metrics  # First, so the startup milestones count the imports below
 import os
 import asyncio
+import csv
+import itertools
 import json
+import tempfile
+import signal
+import secrets
+import hmac
+from typing import TYPE_CHECKING
 from aiohttp import web
-from telegram import Update
-from telegram.ext import (
-    ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes
-)
 import logging
-from collections import defaultdict
+from storage import ShardedStore, VersionConflict, format_video
+from query import QueryError, format_query, parse_query
+from enrich import Enricher
+from metrics import instrument
+
+# telegram and telegram.ext (with httpx under them) take as long to import as
+# everything else here together, so they are imported where they are first
+# used; main() has the web server bound before that happens.
+if TYPE_CHECKING:
+    from telegram import Update
+    from telegram.ext import ContextTypes
 
 logging.basicConfig(level=logging.INFO)
 
 TOKEN = os.getenv("TOKEN")
-if not TOKEN:
-    raise ValueError("TOKEN not set in environment")
 
 # === Video Storage (now includes hashtags) ===
+# Every chat gets its own collection under DATA_DIR. STORAGE_BACKEND picks
+# "sqlite" (default) or "json"; MAX_OPEN_SHARDS and MAX_RESIDENT_VIDEOS bound
+# how many chats' collections stay loaded. Videos saved before collections
+# were per chat (db.json / videos.db) are moved into LEGACY_CHAT_ID's
+# collection the first time that chat is used.
 DB_FILE = "db.json"
+SQLITE_FILE = os.getenv("SQLITE_FILE", "videos.db")
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
+DATA_DIR = os.getenv("DATA_DIR", "data")
+MAX_OPEN_SHARDS = int(os.getenv("MAX_OPEN_SHARDS", 64))
+MAX_RESIDENT_VIDEOS = int(os.getenv("MAX_RESIDENT_VIDEOS", 200_000))
+LEGACY_CHAT_ID = os.getenv("LEGACY_CHAT_ID")
+# Updates from different chats are handled concurrently, up to this many at
+# a time; each chat's own updates still run in order (see updates.py).
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", 32))
+
+shards = ShardedStore(
+    STORAGE_BACKEND,
+    DATA_DIR,
+    max_shards=MAX_OPEN_SHARDS,
+    max_videos=MAX_RESIDENT_VIDEOS,
+    legacy_chat_id=int(LEGACY_CHAT_ID) if LEGACY_CHAT_ID else None,
+    legacy_paths=(DB_FILE, SQLITE_FILE),
+)
 
-if os.path.exists(DB_FILE):
-    with open(DB_FILE, "r") as f:
-        data = json.load(f)
-        video_storage = data.get("videos", [])
-else:
-    video_storage = []
+def chat_store(update):
+    return shards.get(update.effective_chat.id)
+
+# /addvideo, /editvideo and /import wait for the user's next message. The
+# pending step is kept in user_data with the chat it was started in, and only
+# a message in that chat completes it: ids are per chat, so an edit started in
+# one chat must not land on the video with the same id in another.
+def start_pending(update, context, name, **state):
+    context.user_data[name] = {"chat_id": update.effective_chat.id, **state}
+
+def take_pending(update, context, name):
+    state = context.user_data.get(name)
+    if state is None or state["chat_id"] != update.effective_chat.id:
+        return None
+    return context.user_data.pop(name)
+
+def data_dir_bytes():
+    return sum(entry.stat().st_size for entry in os.scandir(DATA_DIR) if entry.is_file())
+
+metrics.Gauge("bot_resident_videos", "Videos in the chat collections currently loaded.", function=lambda: shards.resident_videos())
+metrics.Gauge("bot_open_chats", "Chat collections currently loaded.", function=lambda: shards.open_shards())
+metrics.Gauge("bot_data_dir_bytes", "Size of the files in DATA_DIR.", function=data_dir_bytes)
+
+# === Metadata ===
+# Titles and authors of saved videos are fetched in the background (see
+# enrich.py) and stored next to the video. Set ENRICH_METADATA=0 to turn it off.
+ENRICH_METADATA = os.getenv("ENRICH_METADATA", "1") != "0"
+
+def store_metadata(chat_id, key, metadata):
+    shards.set_metadata(chat_id, key, metadata)
+
+enricher = Enricher(store_metadata)
+
+# === Outgoing messages ===
+# All Bot API calls go through send_scheduler (see sender.py), which keeps
+# within Telegram's rate limits and remembers what was sent for /clear. It is
+# created with the application by build_application().
+DELETE_BATCH_SIZE = 100
+DELETE_CONCURRENCY = 4
+
+send_scheduler = None
+
+# === Pagination ===
+# /list and /search replies are cut into pages that fit in one Telegram
+# message. Each listing gets an opaque cursor token kept in chat_data with the
+# query and the start offset of every page seen so far; the Prev/Next buttons
+# carry "page:<token>:<page>" and only the requested page is rendered.
+MAX_CURSORS_PER_CHAT = 20
+
+def message_length(text):
+    # Telegram counts message length in UTF-16 code units.
+    return len(text.encode("utf-16-le")) // 2
+
+def take_page(items, budget, separator):
+    page = []
+    used = 0
+    for item in items:
+        cost = message_length(item) + (message_length(separator) if page else 0)
+        if used + cost > budget:
+            if page:
+                return page, True
+            # A single item longer than a whole message gets truncated.
+            item = item[:budget]
+            while message_length(item) > budget:
+                item = item[:len(item) - max(1, (message_length(item) - budget) // 2)]
+            return [item], True
+        page.append(item)
+        used += cost
+    return page, False
+
+def new_cursor(context, query):
+    cursors = context.chat_data.setdefault("page_cursors", {})
+    while len(cursors) >= MAX_CURSORS_PER_CHAT:
+        del cursors[next(iter(cursors))]
+    token = secrets.token_urlsafe(6)
+    cursors[token] = {**query, "starts": [0]}
+    return token
+
+def render_page(store, token, cursor, page):
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+    from telegram.constants import MessageLimit
+
+    start = cursor["starts"][page]
+    if cursor["command"] == "list":
+        # A page that starts inside a group repeats the group's headings.
+        header = "".join(line + "\n" for line in store.list_view.headers_at(start))
+        separator = "\n"
+        items = store.list_view.iter_lines(start)
+    else:
+        header = f"Results for {cursor['query']}:\n\n"
+        separator = "\n\n"
+        items = (format_video(v) for v in store.search(parse_query(cursor["query"]), start))
+
+    lines, has_more = take_page(items, MessageLimit.MAX_TEXT_LENGTH - message_length(header), separator)
+    del cursor["starts"][page + 1:]
+    if has_more:
+        cursor["starts"].append(start + len(lines))
+
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀ Prev", callback_data=f"page:{token}:{page - 1}"))
+    if has_more:
+        buttons.append(InlineKeyboardButton("Next ▶", callback_data=f"page:{token}:{page + 1}"))
+    markup = InlineKeyboardMarkup([buttons]) if buttons else None
+
+    # Only blank lines are trimmed; video lines keep their indent.
+    body = separator.join(lines).strip("\n")
+    return (header + body if body else ""), markup
+
+# === Inline mode ===
+# "@bot #gz #ho" in any chat suggests the most used tags of the sender's own
+# collection (their private chat with the bot) that start with "#ho", then
+# the videos carrying "#gz" and the best of those tags. Suggestions come from
+# the collection's tag dictionary (see autocomplete.py).
+INLINE_SUGGESTIONS = 10
+INLINE_VIDEOS = 10
+INLINE_CACHE_TIME = 10
+
+def split_inline_query(text):
+    # The tags already typed, and the prefix of the one being typed ("#" when
+    # the query is empty or ends with a space).
+    words = text.split()
+    if words and words[-1].startswith("#") and not text[-1:].isspace():
+        prefix = words.pop()
+    else:
+        prefix = "#"
+    chosen = list(dict.fromkeys(word.lower() for word in words if word.startswith("#") and len(word) > 1))
+    return chosen, prefix.lower()
+
+def inline_videos(store, tags):
+    if not tags:
+        return []
+    try:
+        query = parse_query(" ".join(tags))
+    except QueryError:
+        return []
+    return list(itertools.islice(store.search(query), INLINE_VIDEOS))
+
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    from telegram import InlineQueryResultArticle, InputTextMessageContent
+
+    query = update.inline_query
+    chat_id = query.from_user.id
+    if not shards.exists(chat_id):
+        await query.answer([], cache_time=INLINE_CACHE_TIME, is_personal=True)
+        return
+
+    await shards.wait_closed(chat_id)
+    store = shards.get(chat_id)
+    chosen, prefix = split_inline_query(query.query)
+    suggestions = [
+        (tag, count) for tag, count in store.complete_tags(prefix, INLINE_SUGGESTIONS + len(chosen))
+        if tag not in chosen
+    ][:INLINE_SUGGESTIONS]
+
+    results = [
+        InlineQueryResultArticle(
+            id=f"tag:{number}",
+            title=tag,
+            description=f"{count} video{'s' if count != 1 else ''}",
+            input_message_content=InputTextMessageContent(" ".join(chosen + [tag])),
+        )
+        for number, (tag, count) in enumerate(suggestions)
+    ]
+    for video in inline_videos(store, chosen + [tag for tag, _ in suggestions[:1]]):
+        results.append(InlineQueryResultArticle(
+            id=f"video:{video.id}",
+            title=video.title or video.url,
+            description=" ".join(video.hashtags),
+            input_message_content=InputTextMessageContent(format_video(video)),
+        ))
+    await query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=True)
+
+# === Import / Export ===
+# /import takes a text (one "URL #tags" per line), CSV (url,hashtags) or JSONL
+# ({"url": ..., "hashtags": [...]}) document. The download is parsed as a
+# stream in batches, then handed to a single add_many, which stores the new
+# videos together and merges the hashtags of already saved ones. /export writes the collection as
+# JSONL into a temporary file, one video at a time, and sends that file.
+IMPORT_BATCH_SIZE = 500
+MAX_IMPORT_VIDEOS = 50_000
+MAX_DOWNLOAD_SIZE = 20 * 1024 * 1024  # getFile limit for bots
+
+def parse_video(text):
+    words = text.split()
+    if not words or not words[0].startswith("http"):
+        return None
+    return {"url": words[0], "hashtags": [word for word in words if word.startswith("#")]}
+
+def iter_import_rows(f, file_name):
+    # Yields a video dict, or None for an entry that isn't a valid video.
+    name = (file_name or "").lower()
+    if name.endswith((".jsonl", ".ndjson", ".json")):
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                row = None
+            if not isinstance(row, dict):
+                yield None
+                continue
+            hashtags = row.get("hashtags", [])
+            if isinstance(hashtags, str):
+                hashtags = hashtags.split()
+            yield parse_video(" ".join([str(row.get("url", ""))] + [str(tag) for tag in hashtags]))
+    elif name.endswith(".csv"):
+        for row in csv.reader(f):
+            if not row or row[0].strip().lower() == "url":
+                continue
+            yield parse_video(" ".join(row))
+    else:
+        for line in f:
+            if line.strip():
+                yield parse_video(line)
+
+async def import_document(update, context):
+    document = update.message.document
+    if document.file_size and document.file_size > MAX_DOWNLOAD_SIZE:
+        await update.message.reply_text("❌ That file is too large. Bots can only download files up to 20 MB.")
+        return
+
+    accepted = []
+    invalid = 0
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "import")
+        telegram_file = await document.get_file()
+        await telegram_file.download_to_drive(path)
+
+        with open(path, "r", encoding="utf-8", errors="replace", newline="") as f:
+            rows = iter_import_rows(f, document.file_name)
+            while len(accepted) < MAX_IMPORT_VIDEOS:
+                batch = list(itertools.islice(rows, IMPORT_BATCH_SIZE))
+                if not batch:
+                    break
+                videos = [video for video in batch if video is not None]
+                invalid += len(batch) - len(videos)
+                accepted.extend(videos)
+                # Let other chats' updates run between batches.
+                await asyncio.sleep(0)
+            # The last batch may end exactly at the cap; peek for more entries.
+            end = object()
+            truncated = len(accepted) > MAX_IMPORT_VIDEOS or (
+                len(accepted) == MAX_IMPORT_VIDEOS and next(rows, end) is not end
+            )
+
+    del accepted[MAX_IMPORT_VIDEOS:]
+    added = merged = 0
+    if accepted:
+        store = chat_store(update)
+        added, merged = store.add_many(accepted)
+        await store.flushed()
+        for video in accepted:
+            enricher.submit(update.effective_chat.id, video["url"])
+
+    summary = f"✅ Imported {added} videos."
+    if merged:
+        summary += f"\n{merged} were already saved; their hashtags were merged."
+    if invalid:
+        summary += f"\nSkipped {invalid} entries without a valid URL."
+    if truncated:
+        summary += f"\nStopped after {MAX_IMPORT_VIDEOS} videos; send the rest in another file."
+    await update.message.reply_text(summary)
 
 # === Handlers ===
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -35,6 +329,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/search - Search videos by hashtags (e.g., /search #food #hotpot)\n"
         "/deletevideo - Delete a video by its number (e.g., /deletevideo 2)\n"
         "/editvideo - Edit a video by its number (e.g., /editvideo 3)\n"
+        "/import - Add many videos at once from a file\n"
+        "/export - Download all saved videos as a file\n"
         "/clear - Clear bot messages from the chat\n"
         "/help - Get help instructions"
     )
@@ -46,10 +342,13 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "   Example: https://www.tiktok.com/... #food #hotpot\n"
         "2. Use /list to see your saved videos.\n"
         "3. Use /search followed by hashtags to find videos. Example: /search #food #hotpot\n"
+        "   Combine with OR, exclude with -#tag, group with ( ) and match prefixes with #tag*.\n"
+        "   Example: /search #gz (#hotpot OR #dimsum) -#closed\n"
         "4. Use /deletevideo followed by the video number to delete. Example: /deletevideo 2\n"
         "5. Use /editvideo followed by the video number to edit. Example: /editvideo 3\n"
-        "6. Use /clear to delete bot messages from the chat.\n"
-        "7. Use /start to see the main menu anytime."
+        "6. Use /import and then send a .txt (one URL with hashtags per line), .csv (url,hashtags) or .jsonl file to add many videos at once. /export sends all saved videos back as a .jsonl file.\n"
+        "7. Use /clear to delete bot messages from the chat.\n"
+        "8. Use /start to see the main menu anytime."
     )
 
 async def addvideo(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -62,72 +361,57 @@ async def addvideo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "📌 Example:\n"
         "https://www.tiktok.com/... #gz #toeat #hotpot"
     )
-    context.user_data['expecting_video'] = True
+    start_pending(update, context, 'expecting_video')
 
 async def list_videos(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not video_storage:
+    store = chat_store(update)
+    if not store.list_view:
         await update.message.reply_text("No videos saved yet. Use /addvideo to add some.")
         return
 
-    grouped = defaultdict(lambda: defaultdict(lambda: defaultdict(list)))
-
-    for video in video_storage:
-        hashtags = video.get("hashtags", [])
-        hashtags_lower = [h.lower() for h in hashtags]
-
-        city_tag = next((tag for tag in hashtags_lower if tag in ["#gz", "#sz"]), None)
-        if not city_tag:
-            city_tag = "#unknown"
-
-        nature_tag = next((tag for tag in hashtags_lower if tag in ["#toexplore", "#toeat", "#tobuy"]), None)
-        if not nature_tag:
-            nature_tag = "#unknown"
-
-        other_tags = [tag for tag in hashtags_lower if tag not in [city_tag, nature_tag]]
-        other_tags_key = " ".join(sorted(other_tags)) if other_tags else "#none"
-
-        grouped[city_tag][nature_tag][other_tags_key].append(video)
-
-    reply_lines = []
-    for city, city_data in grouped.items():
-        reply_lines.append(f"City: {city}")
-        for nature, nature_data in city_data.items():
-            reply_lines.append(f"  Category: {nature}")
-            for tags_group, videos in nature_data.items():
-                reply_lines.append(f"    Tags: {tags_group}")
-                for v in videos:
-                    line = f"      {v['url']} {' '.join(v.get('hashtags', []))}"
-                    reply_lines.append(line)
-                reply_lines.append("")  # Add space between tag groups
-            reply_lines.append("")  # Add space between categories
-        reply_lines.append("")  # Add space between cities
-
-    reply_text = "\n".join(reply_lines).strip()
-    await update.message.reply_text(reply_text)
-
+    token = new_cursor(context, {"command": "list"})
+    reply_text, markup = render_page(store, token, context.chat_data["page_cursors"][token], 0)
+    await update.message.reply_text(reply_text, reply_markup=markup)
 
 async def search_videos(update: Update, context: ContextTypes.DEFAULT_TYPE):
     args = context.args
     if not args:
-        await update.message.reply_text("Please provide at least one hashtag to search. Example: /search #food #hotpot")
+        await update.message.reply_text(
+            "Please provide at least one hashtag to search. Example: /search #food #hotpot\n"
+            "Use OR, -#tag to exclude, (...) to group and #tag* to match a prefix, "
+            "e.g. /search #gz (#hotpot OR #dimsum) -#closed"
+        )
         return
 
-    search_tags = [tag.lower() for tag in args if tag.startswith("#")]
-    if not search_tags:
-        await update.message.reply_text("Please provide valid hashtags starting with '#'.")
+    try:
+        query = parse_query(" ".join(args))
+        store = chat_store(update)
+        token = new_cursor(context, {"command": "search", "query": format_query(query)})
+        reply_text, markup = render_page(store, token, context.chat_data["page_cursors"][token], 0)
+    except QueryError as e:
+        await update.message.reply_text(f"❌ {e}")
         return
 
-    results = []
-    for video in video_storage:
-        video_tags = [h.lower() for h in video.get("hashtags", [])]
-        if all(tag in video_tags for tag in search_tags):
-            results.append(video)
-
-    if not results:
+    if not reply_text:
         await update.message.reply_text("No videos found with the specified hashtags.")
     else:
-        reply = "\n\n".join(f"{v['url']} {' '.join(v['hashtags'])}" for v in results)
-        await update.message.reply_text(f"Results for {' '.join(search_tags)}:\n\n{reply}")
+        await update.message.reply_text(reply_text, reply_markup=markup)
+
+async def change_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    _, token, page = query.data.split(":")
+    cursor = context.chat_data.get("page_cursors", {}).get(token)
+    page = int(page)
+    if cursor is None or page >= len(cursor["starts"]):
+        await query.answer("This list has expired. Run the command again.")
+        return
+
+    reply_text, markup = render_page(chat_store(update), token, cursor, page)
+    await query.answer()
+    if not reply_text:
+        await query.edit_message_text("No more results. Run the command again.")
+    else:
+        await query.edit_message_text(reply_text, reply_markup=markup)
 
 async def deletevideo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     args = context.args
@@ -136,11 +420,12 @@ async def deletevideo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     index = int(args[0]) - 1
-    if 0 <= index < len(video_storage):
-        removed_video = video_storage.pop(index)
-        with open(DB_FILE, "w") as f:
-            json.dump({"videos": video_storage}, f, indent=2)
-        await update.message.reply_text(f"✅ Removed video: {removed_video['url']}")
+    store = chat_store(update)
+    video = store.get(index)
+    if video is not None:
+        removed_video = store.delete(video.id)
+        await store.flushed()
+        await update.message.reply_text(f"✅ Removed video: {removed_video.url}")
     else:
         await update.message.reply_text("❌ Invalid video number. Use /list to see available videos.")
 
@@ -151,8 +436,11 @@ async def editvideo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     index = int(args[0]) - 1
-    if 0 <= index < len(video_storage):
-        context.user_data['editing_video_index'] = index
+    video = chat_store(update).get(index)
+    if video is not None:
+        # The video is remembered by id and version rather than position, so
+        # deletes in between can't redirect the edit to another video.
+        start_pending(update, context, 'editing_video', id=video.id, version=video.version, number=index + 1)
         await update.message.reply_text(
             f"Please send the new video URL and hashtags for video {index + 1}.\nExample: https://www.tiktok.com/... #newtag"
         )
@@ -160,54 +448,160 @@ async def editvideo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Invalid video number. Use /list to see available videos.")
 
 async def clear_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    from telegram.error import TelegramError
+
     chat = update.effective_chat
     bot = context.bot
 
-    async for message in bot.get_chat_history(chat_id=chat.id, limit=100):
-        if message.from_user and message.from_user.id == bot.id:
+    # The Bot API can't list a chat's history, so delete the messages the
+    # send scheduler saw go out, up to 100 per deleteMessages call.
+    message_ids = send_scheduler.take_sent(chat.id)
+    batches = [message_ids[i:i + DELETE_BATCH_SIZE] for i in range(0, len(message_ids), DELETE_BATCH_SIZE)]
+    limit = asyncio.Semaphore(DELETE_CONCURRENCY)
+
+    async def delete_batch(batch):
+        async with limit:
             try:
-                await bot.delete_message(chat_id=chat.id, message_id=message.message_id)
-            except Exception as e:
-                logging.warning(f"Failed to delete message {message.message_id}: {e}")
+                await bot.delete_messages(chat_id=chat.id, message_ids=batch)
+            except TelegramError as e:
+                logging.warning(f"Failed to delete {len(batch)} messages in chat {chat.id}: {e}")
+
+    await asyncio.gather(*(delete_batch(batch) for batch in batches))
 
     await update.message.reply_text("Bot messages have been cleared from the chat.")
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip()
 
-    if context.user_data.get('expecting_video'):
-        if text.startswith("http"):
-            url = text.split()[0]
-            hashtags = [word for word in text.split() if word.startswith("#")]
-            video_storage.append({"url": url, "hashtags": hashtags})
-            with open(DB_FILE, "w") as f:
-                json.dump({"videos": video_storage}, f, indent=2)
-            await update.message.reply_text("✅ Video added successfully! Use /list to view or /search to find by hashtag.")
+    adding = take_pending(update, context, 'expecting_video')
+    editing = None if adding else take_pending(update, context, 'editing_video')
+    if adding:
+        video = parse_video(text)
+        if video:
+            store = chat_store(update)
+            added = store.add(video)
+            await store.flushed()
+            if added:
+                enricher.submit(update.effective_chat.id, video["url"])
+                await update.message.reply_text("✅ Video added successfully! Use /list to view or /search to find by hashtag.")
+            else:
+                await update.message.reply_text("ℹ️ This video is already saved. Any new hashtags were added to it.")
         else:
             await update.message.reply_text("❌ That doesn't look like a valid URL. Please send a correct video link.")
-        context.user_data['expecting_video'] = False
-    elif 'editing_video_index' in context.user_data:
-        index = context.user_data['editing_video_index']
-        if text.startswith("http"):
-            url = text.split()[0]
-            hashtags = [word for word in text.split() if word.startswith("#")]
-            video_storage[index] = {"url": url, "hashtags": hashtags}
-            with open(DB_FILE, "w") as f:
-                json.dump({"videos": video_storage}, f, indent=2)
-            await update.message.reply_text(f"✅ Video {index + 1} updated successfully!")
+    elif editing:
+        video = parse_video(text)
+        if video:
+            store = chat_store(update)
+            try:
+                store.replace(editing["id"], video, expected_version=editing["version"])
+            except VersionConflict:
+                await update.message.reply_text(
+                    f"❌ Video {editing['number']} was changed or deleted since /editvideo. "
+                    "Use /list to check it and try again."
+                )
+                return
+            await store.flushed()
+            enricher.submit(update.effective_chat.id, video["url"])
+            await update.message.reply_text(f"✅ Video {editing['number']} updated successfully!")
         else:
             await update.message.reply_text("❌ That doesn't look like a valid URL. Please send a correct video link.")
-        del context.user_data['editing_video_index']
     else:
         await update.message.reply_text(f"Received: {text}\nUse /help for instructions.")
 
+async def import_videos(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(
+        "📥 Please send a file with the videos to import:\n"
+        "• .txt: one video per line, e.g. https://www.tiktok.com/... #gz #toeat\n"
+        "• .csv: url,hashtags columns\n"
+        "• .jsonl: one {\"url\": ..., \"hashtags\": [...]} per line"
+    )
+    start_pending(update, context, 'expecting_import')
+
+async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    caption = (update.message.caption or "").strip()
+    if take_pending(update, context, 'expecting_import') or caption.startswith("/import"):
+        await import_document(update, context)
+    else:
+        await update.message.reply_text("Use /import before sending a file to add its videos.")
+
+async def export_videos(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    store = chat_store(update)
+    if not store.count():
+        await update.message.reply_text("No videos saved yet. Use /addvideo to add some.")
+        return
+
+    with tempfile.TemporaryFile() as f:
+        for video in store.all():
+            record = {"url": video.url, "hashtags": list(video.hashtags)}
+            f.write((json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
+        f.seek(0)
+        await update.message.reply_document(
+            document=f, filename=f"videos-{update.effective_chat.id}.jsonl"
+        )
+
 # === Minimal HTTP server for Render ===
+# With WEBHOOK_URL set (e.g. https://<service>.onrender.com) Telegram pushes
+# updates to WEBHOOK_PATH on this same server instead of the bot long polling.
+# Requests must carry the secret token registered with set_webhook; accepted
+# updates are queued for the PTB application and answered with 200 straight
+# away, so handler work never holds up Telegram's request.
+#
+# The server is started before the application is built, so health checks
+# pass during startup. BOT_APP holds a future for the PTB application; until
+# it resolves, webhook updates are answered 503 and Telegram retries them.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+
+BOT_APP = web.AppKey("bot_app", asyncio.Future)
+
 async def handle_root(request):
     return web.Response(text="Telegram bot is running.")
 
-async def run_web_app():
+async def handle_metrics(request):
+    return web.Response(text=metrics.render(), content_type="text/plain")
+
+async def handle_update(request):
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(token, WEBHOOK_SECRET):
+        return web.Response(status=403)
+
+    bot_app = request.app[BOT_APP]
+    if not bot_app.done():
+        return web.Response(status=503)
+
+    try:
+        data = await request.json()
+    except ValueError:
+        return web.Response(status=400)
+    if not isinstance(data, dict):
+        return web.Response(status=400)
+
+    from telegram import Update
+
+    application = bot_app.result()
+    try:
+        # None for an empty object; otherwise whatever a malformed field
+        # trips over is raised.
+        update = Update.de_json(data, application.bot)
+    except Exception as e:
+        logging.warning(f"Rejected malformed update: {e!r}")
+        return web.Response(status=400)
+    if update is None:
+        return web.Response(status=400)
+    await application.update_queue.put(update)
+    return web.Response()
+
+def build_web_app(bot_app=None):
     app = web.Application()
-    app.add_routes([web.get('/', handle_root)])
+    app.add_routes([web.get('/', handle_root), web.get('/metrics', handle_metrics)])
+    if bot_app is not None:
+        app[BOT_APP] = bot_app
+        app.add_routes([web.post(WEBHOOK_PATH, handle_update)])
+    return app
+
+async def run_web_app(bot_app=None):
+    app = build_web_app(bot_app)
 
     port = int(os.environ.get("PORT", 10000))
     runner = web.AppRunner(app)
@@ -217,30 +611,89 @@ async def run_web_app():
     logging.info(f"Web server started on port {port}")
 
 # === Main Async Entry ===
+def build_application():
+    # Checked here rather than at import so bench.py can drive the handlers
+    # without a token.
+    if not TOKEN:
+        raise ValueError("TOKEN not set in environment")
+    from telegram.ext import (
+        ApplicationBuilder, CallbackQueryHandler, CommandHandler, InlineQueryHandler, MessageHandler, filters,
+    )
+    from sender import SendScheduler
+    from updates import PerChatUpdateProcessor
+
+    global send_scheduler
+    send_scheduler = SendScheduler()
+    builder = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .rate_limiter(send_scheduler)
+        .concurrent_updates(PerChatUpdateProcessor(shards, MAX_CONCURRENT_UPDATES))
+    )
+    if WEBHOOK_URL:
+        # Updates arrive through handle_update, so no polling Updater is needed.
+        builder = builder.updater(None)
+    app = builder.build()
+
+    app.add_handler(CommandHandler("start", instrument(start)))
+    app.add_handler(CommandHandler("help", instrument(help_command)))
+    app.add_handler(CommandHandler("addvideo", instrument(addvideo)))
+    app.add_handler(CommandHandler("list", instrument(list_videos)))
+    app.add_handler(CommandHandler("search", instrument(search_videos)))
+    app.add_handler(CommandHandler("deletevideo", instrument(deletevideo)))
+    app.add_handler(CommandHandler("editvideo", instrument(editvideo)))
+    app.add_handler(CommandHandler("import", instrument(import_videos)))
+    app.add_handler(CommandHandler("export", instrument(export_videos)))
+    app.add_handler(CommandHandler("clear", instrument(clear_chat)))
+    app.add_handler(CallbackQueryHandler(instrument(change_page), pattern=r"^page:"))
+    app.add_handler(InlineQueryHandler(instrument(inline_query)))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrument(handle_message)))
+    app.add_handler(MessageHandler(filters.Document.ALL, instrument(handle_document)))
+    return app
+
 async def main():
-    app = ApplicationBuilder().token(TOKEN).build()
-
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("help", help_command))
-    app.add_handler(CommandHandler("addvideo", addvideo))
-    app.add_handler(CommandHandler("list", list_videos))
-    app.add_handler(CommandHandler("search", search_videos))
-    app.add_handler(CommandHandler("deletevideo", deletevideo))
-    app.add_handler(CommandHandler("editvideo", editvideo))
-    app.add_handler(CommandHandler("clear", clear_chat))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    bot_app = asyncio.get_running_loop().create_future()
+    await run_web_app(bot_app if WEBHOOK_URL else None)
+    metrics.mark_startup("port_bound")
 
+    if ENRICH_METADATA:
+        await enricher.start()
+
+    app = build_application()
     await app.initialize()
     await app.start()
-    await app.updater.start_polling()
-
-    await run_web_app()
-
-    await asyncio.Event().wait()
-
-    await app.updater.stop_polling()
-    await app.stop()
-    await app.shutdown()
+    bot_app.set_result(app)
+    if WEBHOOK_URL:
+        from telegram import Update
+
+        await app.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+        )
+        logging.info(f"Receiving updates via webhook at {WEBHOOK_PATH}")
+    else:
+        await app.updater.start_polling()
+    metrics.mark_startup("ready")
+
+    lag_probe = asyncio.create_task(metrics.loop_lag.run())
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    try:
+        await stop_event.wait()
+    finally:
+        lag_probe.cancel()
+        await enricher.close()
+        if app.updater:
+            await app.updater.stop_polling()
+        await app.stop()
+        await app.shutdown()
+        # Drain the writers so every acknowledged mutation is on disk.
+        shards.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
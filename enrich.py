@@ -0,0 +1,311 @@
+import asyncio
+import html
+import ipaddress
+import logging
+import random
+import re
+import socket
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit
+import aiohttp
+from aiohttp.abc import AbstractResolver
+from aiohttp.resolver import DefaultResolver
+from yarl import URL
+import metrics
+from storage import canonical_url
+
+# === Metadata enrichment ===
+# Saved videos are a URL and hashtags; the title and author shown by /list
+# and /search are fetched in the background after a video is added or
+# edited. submit() only queues the URL, and a fixed pool of workers takes it
+# from there:
+#   1. links to a site with an oEmbed endpoint (OEMBED_ENDPOINTS) are sent
+#      straight to it for the title and author;
+#   2. short links (SHORT_LINK_HOSTS: vm.tiktok.com/..., xhslink.com/...)
+#      are followed one redirect at a time. Once one lands on a site with an
+#      oEmbed endpoint, that endpoint is asked; a chain that ends elsewhere
+#      has the page it ended on read for its og:title / og:site_name tags or
+#      <title>. Links to any other site are never fetched;
+#   3. the result is handed to store_metadata(chat_id, key, metadata), which
+#      stores it next to the video (see set_metadata in storage.py).
+# All requests share one ClientSession, whose connector caps the number of
+# open connections. Results are kept in a TTLCache by canonical key, so the
+# same video saved in many chats, or edited, is fetched once. Lookups that
+# found nothing are cached for a shorter time (negative caching). Timeouts,
+# connection errors, 429s and 5xx responses are retried with exponential
+# backoff and jitter.
+#
+# Saved links come from any chat member, so nothing they point at may reach
+# the bot's own network: every redirect hop must be http(s), IP literals must
+# be public addresses, and host names are resolved by PublicResolver, which
+# drops loopback, private, link-local and other non-global addresses.
+#
+# Endpoints are plain URLs and every request goes through the session, so
+# the pipeline can be pointed at a local stub server:
+#   Enricher(store_metadata, endpoints={"tiktok": "http://127.0.0.1:8080/oembed"}, resolver=...)
+# (test_enrich.py passes a resolver that maps every host to the stub).
+
+ENRICH_WORKERS = 4
+ENRICH_QUEUE_SIZE = 1000
+MAX_CONNECTIONS = 8
+REQUEST_TIMEOUT = 10
+MAX_ATTEMPTS = 3
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+MAX_PAGE_BYTES = 256 * 1024
+CACHE_SIZE = 10_000
+CACHE_TTL = 24 * 3600
+NEGATIVE_CACHE_TTL = 600
+MAX_REDIRECTS = 5
+USER_AGENT = "Mozilla/5.0 (compatible; gz_trip_bot/1.0)"
+
+OEMBED_ENDPOINTS = {
+    "tiktok": "https://www.tiktok.com/oembed",
+    "youtube": "https://www.youtube.com/oembed",
+}
+SHORT_LINK_HOSTS = {"vm.tiktok.com", "vt.tiktok.com", "v.douyin.com", "xhslink.com", "youtu.be"}
+
+META_RE = re.compile(r"<meta\s[^>]*>", re.IGNORECASE)
+ATTR_RE = re.compile(r"""([\w:-]+)\s*=\s*(?:"([^"]*)"|'([^']*)')""")
+TITLE_RE = re.compile(r"<title[^>]*>(.*?)</title>", re.IGNORECASE | re.DOTALL)
+
+NOT_FOUND = object()
+
+
+class TTLCache:
+    # LRU of canonical key -> metadata dict, or NOT_FOUND for a lookup that
+    # found nothing. Entries expire after their ttl.
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires <= time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value, ttl):
+        self.entries[key] = (value, time.monotonic() + ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+class PublicResolver(AbstractResolver):
+    # Resolves through resolver and keeps only globally routable addresses.
+    def __init__(self, resolver=None):
+        self.resolver = resolver or DefaultResolver()
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        hosts = [entry for entry in await self.resolver.resolve(host, port, family) if is_public_address(entry["host"])]
+        if not hosts:
+            raise OSError(f"{host} has no public address")
+        return hosts
+
+    async def close(self):
+        await self.resolver.close()
+
+
+def is_public_address(address):
+    return ipaddress.ip_address(address.split("%", 1)[0]).is_global
+
+
+def is_short_link(url):
+    try:
+        return (urlsplit(url).hostname or "").lower() in SHORT_LINK_HOSTS
+    except ValueError:
+        return False
+
+
+def is_fetchable(url):
+    # IP literals are connected to without going through the resolver.
+    try:
+        parts = urlsplit(url)
+    except ValueError:
+        return False
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        return False
+    try:
+        return is_public_address(parts.hostname)
+    except ValueError:
+        return True
+
+
+class RetryableError(Exception):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_page_metadata(text):
+    properties = {}
+    for tag in META_RE.findall(text):
+        attrs = {name.lower(): a if a else b for name, a, b in ATTR_RE.findall(tag)}
+        name = attrs.get("property") or attrs.get("name")
+        if name and "content" in attrs:
+            properties.setdefault(name.lower(), html.unescape(attrs["content"]).strip())
+    title = properties.get("og:title") or properties.get("twitter:title")
+    if not title:
+        match = TITLE_RE.search(text)
+        title = html.unescape(match.group(1)).strip() if match else None
+    author = properties.get("author") or properties.get("og:site_name")
+    return {"title": title, "author": author} if title else None
+
+
+class Enricher:
+    def __init__(self, store_metadata, endpoints=None, workers=ENRICH_WORKERS,
+                 queue_size=ENRICH_QUEUE_SIZE, max_connections=MAX_CONNECTIONS, resolver=None):
+        self.store_metadata = store_metadata
+        self.endpoints = OEMBED_ENDPOINTS if endpoints is None else endpoints
+        self.resolver = resolver
+        self.workers = workers
+        self.queue_size = queue_size
+        self.max_connections = max_connections
+        self.cache = TTLCache()
+        self.session = None
+        self._queue = None
+        self._tasks = []
+        self._queued = set()
+
+    async def start(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=self.max_connections, ttl_dns_cache=300, resolver=self.resolver or PublicResolver()
+            ),
+            timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT),
+            headers={"User-Agent": USER_AGENT},
+        )
+        self._queue = asyncio.Queue(self.queue_size)
+        self._tasks = [asyncio.create_task(self._work(), name=f"enrich-{i}") for i in range(self.workers)]
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def submit(self, chat_id, url):
+        # Never waits: before start() (e.g. under bench.py) and once the queue
+        # is full, the video is simply left without metadata.
+        if self._queue is None:
+            return
+        item = (chat_id, url)
+        if item in self._queued:
+            return
+        try:
+            self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            metrics.ENRICHMENTS.inc("dropped")
+            return
+        self._queued.add(item)
+
+    async def _work(self):
+        while True:
+            chat_id, url = item = await self._queue.get()
+            self._queued.discard(item)
+            try:
+                metadata = await self.lookup(url)
+                if metadata is not None:
+                    self.store_metadata(chat_id, canonical_url(url), metadata)
+            except Exception:
+                logging.exception(f"Failed to enrich {url}")
+            finally:
+                self._queue.task_done()
+
+    async def lookup(self, url):
+        # Returns {"title": ..., "author": ...} or None.
+        key = canonical_url(url)
+        cached = self.cache.get(key)
+        if cached is not None:
+            metrics.ENRICHMENTS.inc("cached")
+            return None if cached is NOT_FOUND else cached
+
+        started = time.perf_counter()
+        try:
+            metadata = await self._with_retries(self._fetch, url, key)
+        except (RetryableError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # Out of retries; try again once the negative entry expires.
+            logging.info(f"Giving up on metadata for {url}: {e}")
+            metrics.ENRICHMENTS.inc("failed")
+            metadata = None
+        else:
+            metrics.ENRICHMENTS.inc("fetched" if metadata else "not_found")
+        metrics.ENRICHMENT_SECONDS.observe(time.perf_counter() - started)
+
+        self.cache.put(key, metadata or NOT_FOUND, CACHE_TTL if metadata else NEGATIVE_CACHE_TTL)
+        return metadata
+
+    async def _with_retries(self, fetch, *args):
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                return await fetch(*args)
+            except (RetryableError, aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt == MAX_ATTEMPTS - 1:
+                    raise
+                delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+                if isinstance(e, RetryableError) and e.retry_after is not None:
+                    delay = min(BACKOFF_MAX, max(delay, e.retry_after))
+                await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+
+    def _endpoint(self, key):
+        # Keys of URLs with a readable video id are "<site>:<id>".
+        return self.endpoints.get(key.split(":", 1)[0]) if ":" in key else None
+
+    async def _fetch(self, url, key):
+        endpoint = self._endpoint(key)
+        if endpoint:
+            return await self._fetch_oembed(endpoint, url)
+        if not is_short_link(url):
+            return None
+        # Redirects are followed by hand so every hop is checked.
+        for _ in range(MAX_REDIRECTS + 1):
+            if not is_fetchable(url):
+                return None
+            async with self.session.get(url, allow_redirects=False) as response:
+                location = response.headers.get("Location") if 300 <= response.status < 400 else None
+                if location is None:
+                    return await self._read_page(response)
+                url = str(response.url.join(URL(location)))
+            endpoint = self._endpoint(canonical_url(url))
+            if endpoint:
+                # The video itself is never fetched, only its oEmbed data.
+                return await self._fetch_oembed(endpoint, url)
+        return None
+
+    async def _fetch_oembed(self, endpoint, url):
+        async with self.session.get(endpoint, params={"url": url, "format": "json"}) as response:
+            if response.status in (400, 401, 403, 404):
+                return None
+            self._check(response)
+            data = await response.json(content_type=None)
+        if not isinstance(data, dict) or not data.get("title"):
+            return None
+        return {"title": str(data["title"]).strip(), "author": data.get("author_name")}
+
+    async def _read_page(self, response):
+        if 400 <= response.status < 500 and response.status != 429:
+            return None
+        self._check(response)
+        if "html" not in response.headers.get("Content-Type", ""):
+            return None
+        body = await response.content.read(MAX_PAGE_BYTES)
+        return parse_page_metadata(body.decode(response.charset or "utf-8", errors="replace"))
+
+    def _check(self, response):
+        if response.status == 429 or response.status >= 500:
+            retry_after = response.headers.get("Retry-After", "")
+            raise RetryableError(
+                f"HTTP {response.status} from {response.url}",
+                retry_after=float(retry_after) if retry_after.isdigit() else None,
+            )
+        response.raise_for_status()
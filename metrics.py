@@ -0,0 +1,223 @@
+import asyncio
+import bisect
+import contextvars
+import functools
+import logging
+import threading
+import time
+from collections import defaultdict
+
+# === Metrics ===
+# A small in-process registry rendered in the Prometheus text format on
+# /metrics. Metrics may be updated from the storage writer threads, so every
+# update takes the metric's lock. Handlers registered through instrument()
+# record their latency and failures, and the size of every message they send:
+# the send scheduler calls observe_reply() for each outgoing message, and the
+# current handler is known through a context variable.
+#
+# Startup is timed from the moment this module is imported, which bot.py does
+# before anything else: mark_startup() records how long each milestone took
+# to reach (the port bound, the application ready, the first update answered).
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (64, 256, 1024, 2048, 4096, 16384, 65536)
+LOOP_LAG_INTERVAL = 0.5
+
+PROCESS_STARTED = time.perf_counter()
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            lines.extend(self._samples())
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self.values = defaultdict(int)
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self.values[labels] += amount
+
+    def _samples(self):
+        for labels, value in sorted(self.values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+
+class Gauge(Metric):
+    # Either set() explicitly or computed at scrape time by a function that
+    # returns the value (or, with labels, a {labels tuple: value} dict).
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labelnames=(), function=None):
+        super().__init__(name, help_text, labelnames)
+        self.values = {}
+        self.function = function
+
+    def set(self, value, *labels):
+        with self._lock:
+            self.values[labels] = value
+
+    def _samples(self):
+        values = self.values
+        if self.function is not None:
+            try:
+                values = self.function()
+            except Exception:
+                logging.exception(f"Failed to compute {self.name}")
+                return
+            if not isinstance(values, dict):
+                values = {(): values}
+        for labels, value in sorted(values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self.counts = {}
+        self.sums = defaultdict(float)
+
+    def observe(self, value, *labels):
+        with self._lock:
+            counts = self.counts.get(labels)
+            if counts is None:
+                counts = self.counts[labels] = [0] * len(self.buckets)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sums[labels] += value
+
+    def _samples(self):
+        for labels, counts in sorted(self.counts.items()):
+            total = 0
+            for bound, count in zip(self.buckets, counts):
+                total += count
+                le = _format_labels(self.labelnames, labels, [("le", _format_value(bound))])
+                yield f"{self.name}_bucket{le} {total}"
+            label_text = _format_labels(self.labelnames, labels)
+            yield f"{self.name}_sum{label_text} {_format_value(self.sums[labels])}"
+            yield f"{self.name}_count{label_text} {total}"
+
+
+REGISTRY = []
+
+HANDLER_SECONDS = Histogram("bot_handler_duration_seconds", "Time spent in each update handler.", ["handler"])
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Update handlers that raised, by exception type.", ["handler", "error"])
+REPLY_BYTES = Histogram(
+    "bot_reply_bytes", "UTF-8 size of the text of each message sent, by handler.", ["handler"], buckets=SIZE_BUCKETS
+)
+STORAGE_COMMIT_SECONDS = Histogram(
+    "bot_storage_commit_seconds", "Time to write and sync one group commit, by writer.", ["writer"]
+)
+SEARCH_CACHE = Counter("bot_search_cache_total", "Search result cache lookups, by hit or miss.", ["result"])
+STORAGE_COMMIT_WRITES = Counter("bot_storage_commit_writes_total", "Writes persisted by group commits.", ["writer"])
+
+ENRICHMENTS = Counter(
+    "bot_enrichment_total", "Metadata lookups, by fetched, cached, not_found, failed or dropped.", ["result"]
+)
+ENRICHMENT_SECONDS = Histogram("bot_enrichment_fetch_seconds", "Time to fetch the metadata of one video, retries included.")
+STARTUP_SECONDS = Gauge(
+    "bot_startup_seconds", "Seconds from the bot starting up to each startup milestone.", ["milestone"]
+)
+
+current_handler = contextvars.ContextVar("current_handler", default="none")
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def mark_startup(milestone):
+    # Only the first time each milestone is reached counts.
+    if (milestone,) in STARTUP_SECONDS.values:
+        return
+    elapsed = time.perf_counter() - PROCESS_STARTED
+    STARTUP_SECONDS.set(elapsed, milestone)
+    logging.info(f"Startup: {milestone} after {elapsed:.3f}s")
+
+
+def instrument(handler):
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        token = current_handler.set(name)
+        started = time.perf_counter()
+        try:
+            result = await handler(update, context)
+            mark_startup("first_response")
+            return result
+        except Exception as e:
+            HANDLER_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+            current_handler.reset(token)
+    return wrapper
+
+
+def observe_reply(data):
+    text = data.get("text") or data.get("caption")
+    if isinstance(text, str):
+        REPLY_BYTES.observe(len(text.encode("utf-8")), current_handler.get())
+
+
+class LoopLagProbe:
+    # Sleeps for interval at a time; anything later than that it wakes up was
+    # spent waiting for other callbacks to yield the loop.
+    def __init__(self, interval=LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self.last = 0.0
+        self.worst = 0.0
+
+    def take_worst(self):
+        worst, self.worst = self.worst, self.last
+        return worst
+
+    async def run(self):
+        while True:
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            self.last = max(0.0, time.perf_counter() - expected)
+            self.worst = max(self.worst, self.last)
+
+
+loop_lag = LoopLagProbe()
+LOOP_LAG = Gauge("bot_event_loop_lag_seconds", "How late the last event loop lag probe woke up.", function=lambda: loop_lag.last)
+LOOP_LAG_MAX = Gauge(
+    "bot_event_loop_lag_max_seconds", "Largest event loop lag since the last scrape.", function=loop_lag.take_worst
+)
@@ -0,0 +1,267 @@
+import re
+from collections import OrderedDict, namedtuple
+import metrics
+
+# === Hashtag query language ===
+# /search accepts boolean queries over hashtags:
+#
+#   #gz (#hotpot OR #dimsum) -#closed #hot*
+#
+# Terms next to each other (or joined by AND) must all match, OR matches
+# either side, a leading "-" or NOT excludes, parentheses group and a
+# trailing "*" matches every tag with that prefix. Tags compare
+# case-insensitively. parse_query() builds an AST of the nodes below and
+# normalizes it, so equivalent queries format_query() to the same string,
+# which is also the result cache key.
+#
+# Evaluation works on sets of video ids from a store's tag index (see
+# TagIndex and SqliteTagIndex in storage.py), which provides:
+#   count(tag)                -- number of videos with tag
+#   posting(tag)              -- their ids; a set or sorted array the caller
+#                                must not modify
+#   restrict(tag, candidates, count)
+#                             -- the candidates (a set) that have tag, given
+#                                its count
+#   tags_with_prefix(prefix)  -- matching tags from the sorted tag dictionary
+#   universe()                -- ids of every video
+# The planner evaluates the cheapest positive term of an AND first and only
+# filters that set through the others, so the work is bounded by the rarest
+# term rather than the size of the collection.
+
+MAX_QUERY_TERMS = 32
+MAX_PREFIX_EXPANSION = 500
+RESULT_CACHE_SIZE = 128
+
+Tag = namedtuple("Tag", "name")
+Prefix = namedtuple("Prefix", "prefix")
+And = namedtuple("And", "children")
+Or = namedtuple("Or", "children")
+Not = namedtuple("Not", "child")
+
+TOKEN_RE = re.compile(r"\(|\)|-|[^\s()]+")
+
+
+class QueryError(ValueError):
+    pass
+
+
+# === Parsing ===
+class Parser:
+    def __init__(self, text):
+        self.tokens = TOKEN_RE.findall(text)
+        self.pos = 0
+        self.terms = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def next(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def parse(self):
+        if not self.tokens:
+            raise QueryError("Please provide at least one hashtag to search.")
+        node = self.parse_or()
+        if self.peek() is not None:
+            raise QueryError(f"Unexpected '{self.peek()}' in the query.")
+        return node
+
+    def parse_or(self):
+        children = [self.parse_and()]
+        while self.peek() is not None and self.peek().upper() == "OR":
+            self.next()
+            children.append(self.parse_and())
+        return children[0] if len(children) == 1 else Or(tuple(children))
+
+    def parse_and(self):
+        children = [self.parse_unary()]
+        while self.peek() not in (None, ")") and self.peek().upper() != "OR":
+            if self.peek().upper() == "AND":
+                self.next()
+            children.append(self.parse_unary())
+        return children[0] if len(children) == 1 else And(tuple(children))
+
+    def parse_unary(self):
+        token = self.peek()
+        if token is not None and (token == "-" or token.upper() == "NOT"):
+            self.next()
+            return Not(self.parse_unary())
+        return self.parse_atom()
+
+    def parse_atom(self):
+        token = self.next()
+        if token is None:
+            raise QueryError("The query ends too early.")
+        if token == "(":
+            node = self.parse_or()
+            if self.next() != ")":
+                raise QueryError("A '(' in the query is never closed.")
+            return node
+        if token == ")" or token.upper() in ("AND", "OR"):
+            raise QueryError(f"Unexpected '{token}' in the query.")
+        if not token.startswith("#"):
+            raise QueryError(f"'{token}' is not a hashtag; hashtags start with '#'.")
+        self.terms += 1
+        if self.terms > MAX_QUERY_TERMS:
+            raise QueryError(f"Queries can use at most {MAX_QUERY_TERMS} hashtags.")
+        token = token.lower()
+        if token.endswith("*"):
+            return Prefix(token.rstrip("*"))
+        return Tag(token)
+
+
+def normalize(node):
+    # Flattens nested AND/OR, drops double negation and duplicate terms and
+    # sorts terms, so that equivalent queries compare (and cache) equal.
+    if isinstance(node, Not):
+        child = normalize(node.child)
+        return child.child if isinstance(child, Not) else Not(child)
+    if isinstance(node, (And, Or)):
+        children = set()
+        for child in map(normalize, node.children):
+            if type(child) is type(node):
+                children.update(child.children)
+            else:
+                children.add(child)
+        if len(children) == 1:
+            return children.pop()
+        return type(node)(tuple(sorted(children, key=format_query)))
+    return node
+
+
+def format_query(node, parent=None):
+    if isinstance(node, Tag):
+        return node.name
+    if isinstance(node, Prefix):
+        return node.prefix + "*"
+    if isinstance(node, Not):
+        return "-" + format_query(node.child, node)
+    if isinstance(node, And):
+        text = " ".join(format_query(child, node) for child in node.children)
+        return f"({text})" if isinstance(parent, Not) else text
+    text = " OR ".join(format_query(child, node) for child in node.children)
+    return f"({text})" if parent is not None else text
+
+
+def parse_query(text):
+    return normalize(Parser(text).parse())
+
+
+# === Planning and evaluation ===
+class Planner:
+    def __init__(self, index):
+        self.index = index
+        self._counts = {}
+        self._prefixes = {}
+
+    def count(self, tag):
+        if tag not in self._counts:
+            self._counts[tag] = self.index.count(tag)
+        return self._counts[tag]
+
+    def expand(self, prefix):
+        if prefix not in self._prefixes:
+            tags = self.index.tags_with_prefix(prefix)
+            if len(tags) > MAX_PREFIX_EXPANSION:
+                raise QueryError(f"'{prefix}*' matches too many hashtags; use a longer prefix.")
+            self._prefixes[prefix] = tags
+        return self._prefixes[prefix]
+
+    def estimate(self, node):
+        # Upper bound on the number of matching videos, or None when the term
+        # only matches by exclusion and would need the whole collection.
+        if isinstance(node, Tag):
+            return self.count(node.name)
+        if isinstance(node, Prefix):
+            return sum(self.count(tag) for tag in self.expand(node.prefix))
+        if isinstance(node, Not):
+            return None
+        estimates = [self.estimate(child) for child in node.children]
+        if isinstance(node, Or):
+            return None if None in estimates else sum(estimates)
+        bounded = [e for e in estimates if e is not None]
+        return min(bounded) if bounded else None
+
+    def evaluate(self, node):
+        estimate = self.estimate(node)
+        if estimate is None:
+            return self.restrict(node, self.index.universe())
+        if isinstance(node, Tag):
+            return self.index.posting(node.name)
+        if isinstance(node, Prefix):
+            return set().union(*(self.index.posting(tag) for tag in self.expand(node.prefix)))
+        if isinstance(node, Or):
+            return set().union(*(self.evaluate(child) for child in node.children))
+        # AND: start from the cheapest bounded term, filter through the rest
+        # in order of estimated size.
+        ordered = sorted(node.children, key=self._cost)
+        result = as_set(self.evaluate(ordered[0]))
+        return self._restrict_all(ordered[1:], result)
+
+    def _cost(self, node):
+        estimate = self.estimate(node)
+        return (estimate is None, estimate or 0)
+
+    def restrict(self, node, candidates):
+        # The candidates matching node.
+        if not candidates:
+            return candidates
+        if isinstance(node, Tag):
+            return self.index.restrict(node.name, candidates, self.count(node.name))
+        if isinstance(node, Prefix):
+            return set().union(*(
+                self.index.restrict(tag, candidates, self.count(tag)) for tag in self.expand(node.prefix)
+            ))
+        if isinstance(node, Not):
+            return candidates - self.restrict(node.child, candidates)
+        if isinstance(node, Or):
+            result = set()
+            for child in node.children:
+                result |= self.restrict(child, candidates - result)
+            return result
+        return self._restrict_all(sorted(node.children, key=self._cost), candidates)
+
+    def _restrict_all(self, nodes, candidates):
+        for node in nodes:
+            if not candidates:
+                break
+            candidates = self.restrict(node, candidates)
+        return candidates
+
+
+def as_set(ids):
+    return ids if isinstance(ids, (set, frozenset)) else set(ids)
+
+
+def evaluate(node, index):
+    # Ids of the videos matching node, in insertion order.
+    return sorted(Planner(index).evaluate(node))
+
+
+# === Result cache ===
+class ResultCache:
+    # LRU of normalized query -> sorted ids. Stores clear it on every
+    # mutation, so entries never outlive the data they were computed from.
+    def __init__(self, size=RESULT_CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        ids = self.entries.get(key)
+        if ids is None:
+            metrics.SEARCH_CACHE.inc("miss")
+            return None
+        self.entries.move_to_end(key)
+        metrics.SEARCH_CACHE.inc("hit")
+        return ids
+
+    def put(self, key, ids):
+        self.entries[key] = ids
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+import metrics
+
+# === Outbound send scheduler ===
+# Plugged into the Application as its rate limiter, so every Bot API call the
+# handlers make passes through here. Calls aimed at a chat wait for a token
+# from the global bucket and from that chat's bucket, following Telegram's
+# broadcast limits (about 30 messages/s overall, 1/s per private chat and
+# 20/min per group). A RetryAfter pauses all chat-bound calls for the time
+# Telegram asks for, then the call is retried. Overlapping RetryAfters only
+# ever push the end of the pause later, never earlier.
+#
+# The scheduler also remembers the ids of the last SENT_HISTORY messages the
+# bot sent to each chat, because the Bot API offers no way to list them
+# afterwards; /clear deletes from that record. Only the SENT_CHATS chats sent
+# to most recently are remembered.
+
+GLOBAL_RATE = 30
+PRIVATE_CHAT_RATE = 1
+GROUP_CHAT_RATE = 20 / 60
+CHAT_BURST = 3
+MAX_RETRIES = 3
+SENT_HISTORY = 200
+SENT_CHATS = 10_000
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def is_idle(self):
+        self._refill()
+        return self.tokens >= self.capacity and not self._lock.locked()
+
+    async def acquire(self):
+        # The lock queues waiters in arrival order.
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class SendScheduler(BaseRateLimiter):
+    def __init__(self, global_rate=GLOBAL_RATE, max_retries=MAX_RETRIES, history=SENT_HISTORY):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.max_retries = max_retries
+        self.chat_buckets = {}
+        self.history = history
+        self.sent = OrderedDict()
+        self.paused_until = 0.0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 10_000:
+                # Full buckets carry no state worth keeping.
+                for idle in [c for c, b in self.chat_buckets.items() if b.is_idle()]:
+                    del self.chat_buckets[idle]
+            # Negative ids are groups, supergroups and channels.
+            rate = GROUP_CHAT_RATE if chat_id < 0 else PRIVATE_CHAT_RATE
+            bucket = self.chat_buckets[chat_id] = TokenBucket(rate, CHAT_BURST)
+        return bucket
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            # Calls without a chat (answerCallbackQuery, getMe, ...) and
+            # @channel usernames skip the per-chat bucket.
+            chat_id = None
+
+        for attempt in range(self.max_retries + 1):
+            if "chat_id" in data:
+                await self._wait_unpaused()
+                await self.global_bucket.acquire()
+                if chat_id is not None:
+                    await self._chat_bucket(chat_id).acquire()
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                logging.info(f"Flood limit on {endpoint}, pausing sends for {e.retry_after}s")
+                self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+                await self._wait_unpaused()
+                continue
+            if endpoint.startswith(("send", "forward")):
+                self._record(result)
+            if endpoint.startswith(("send", "edit")):
+                metrics.observe_reply(data)
+            return result
+
+    async def _wait_unpaused(self):
+        # Re-reads the deadline after each sleep, since a later RetryAfter
+        # may have moved it.
+        while True:
+            delay = self.paused_until - time.monotonic()
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+    def _record(self, result):
+        messages = result if isinstance(result, list) else [result]
+        for message in messages:
+            if isinstance(message, dict) and "message_id" in message and "chat" in message:
+                chat_id = message["chat"]["id"]
+                sent = self.sent.get(chat_id)
+                if sent is None:
+                    sent = self.sent[chat_id] = deque(maxlen=self.history)
+                    while len(self.sent) > SENT_CHATS:
+                        self.sent.popitem(last=False)
+                else:
+                    self.sent.move_to_end(chat_id)
+                sent.append(message["message_id"])
+
+    def take_sent(self, chat_id):
+        sent = self.sent.pop(chat_id, None)
+        return list(sent) if sent else []
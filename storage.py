@@ -0,0 +1,1703 @@
+import os
+import re
+import asyncio
+import bisect
+import itertools
+import json
+import logging
+import queue
+import sqlite3
+import struct
+import sys
+import threading
+import time
+from array import array
+from collections import Counter, OrderedDict
+from concurrent.futures import Future
+from operator import attrgetter
+from urllib.parse import parse_qsl, urlencode, urlsplit
+import metrics
+from query import ResultCache, evaluate, format_query
+from autocomplete import TagDictionary
+
+# === Storage backends ===
+# Every backend exposes the same small interface used by the handlers:
+#   count(), get(index), all(), search(query, start)   -- reads, synchronous;
+#       all() and search() are iterators; search() takes a parsed query
+#       (see query.py) and caches its matches until the next mutation
+#   list_view   -- ListView kept up to date by the mutations below
+# The tag index, list view and duplicate index are built on first use rather
+# than when a store is opened: reads build the ones they need, and every
+# mutation builds all of them first so they never have to catch up. The tag
+# dictionary is only built by complete_tags() and kept up to date from then on.
+#   find(video_id)   -- read, the video with that id or None
+#   complete_tags(prefix, limit)
+#       -- read, the most used tags starting with prefix with their video
+#          counts, from a TagDictionary (see autocomplete.py)
+#   add(video), add_many(videos), replace(video_id, video, expected_version),
+#   delete(video_id, expected_version)
+#       -- mutations; add_many stores its new videos with one journal
+#          record / one transaction. Adding an already stored video merges
+#          its hashtags into the stored one instead (see DedupingStore).
+#          replace() and delete() raise VersionConflict if the video is gone
+#          or, when expected_version is given, has been changed since.
+#   set_metadata(key, metadata)
+#       -- stores the title and author fetched for the video with that
+#          canonical key (see enrich.py); not a change to the video, so its
+#          version stays the same
+#   flushed()   -- awaitable, resolves once earlier mutations are durable
+#   close()   -- blocking, drains pending writes
+# Mutations take {"url": ..., "hashtags": [...]} dicts or Video records;
+# reads return Video records (see below). Every stored video has an id,
+# handed out in increasing order by its store and never reused, and a version
+# that goes up with each change. Positions in insertion order (get(index))
+# are what users see; handlers turn them into ids straight away, so a
+# mutation never lands on a video that moved in the meantime. Each store
+# holds one chat's collection; ShardedStore hands them out per chat.
+
+COMPACT_EVERY = 1000
+GROUP_COMMIT_WINDOW = 0.005
+SQL_CHUNK_SIZE = 500
+CITY_TAGS = ["#gz", "#sz"]
+CATEGORY_TAGS = ["#toexplore", "#toeat", "#tobuy"]
+
+
+def normalize_tag(tag):
+    return tag.lower()
+
+
+def format_video(video):
+    text = f"{video.url} {' '.join(video.hashtags)}"
+    if video.title:
+        text += f" — {video.title}"
+        if video.author:
+            text += f" ({video.author})"
+    return text
+
+
+class VersionConflict(Exception):
+    pass
+
+
+STORE_SUFFIXES = {"json": ".json", "sqlite": ".db"}
+
+
+def open_store(backend, path, legacy_json_path=None):
+    if backend == "json":
+        return JsonStore(path)
+    if backend == "sqlite":
+        return SqliteStore(path, legacy_json_path=legacy_json_path)
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+# === Canonical URLs ===
+# The same video is shared under many URLs: tracking query strings, mobile
+# and desktop hosts, http vs https. canonical_url() reduces a URL to a key
+# that is the same for all of them: "<site>:<video id>" where the id can be
+# read from the URL, otherwise host + path + the non-tracking query params.
+# Short links (vm.tiktok.com/ZM..., xhslink.com/...) carry no id and key on
+# their own code. Text urlsplit() can't parse ("http://[oops") is its own key.
+VIDEO_ID_PATTERNS = [
+    ("tiktok", "tiktok.com", re.compile(r"/(?:video|v)/(\d+)")),
+    ("douyin", "douyin.com", re.compile(r"/(?:video|note)/(\d+)")),
+    ("douyin", "iesdouyin.com", re.compile(r"/share/(?:video|note)/(\d+)")),
+    ("xhs", "xiaohongshu.com", re.compile(r"/(?:explore|discovery/item)/([0-9a-f]{24})")),
+    ("youtube", "youtube.com", re.compile(r"/(?:shorts|embed|live)/([\w-]{11})")),
+    ("youtube", "youtu.be", re.compile(r"^/([\w-]{11})")),
+    ("instagram", "instagram.com", re.compile(r"/(?:p|reels?|tv)/([\w-]+)")),
+]
+TRACKING_PARAMS = {
+    "fbclid", "gclid", "igshid", "igsh", "si", "feature", "ref", "share_source",
+    "is_from_webapp", "sender_device", "sender_web_id", "is_copy_url",
+    "share_app_id", "share_item_id", "share_link_id", "u_code", "_r", "_t",
+    "xsec_token", "xsec_source", "app_platform", "app_version", "author_share",
+    "apptime", "appuid", "shareRedId", "share_from_user_hidden",
+}
+
+
+def canonical_url(url):
+    url = url.strip()
+    try:
+        parts = urlsplit(url)
+    except ValueError:
+        return url
+    host = (parts.hostname or "").lower()
+    for prefix in ("www.", "m.", "mobile."):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+            break
+    path = parts.path.rstrip("/")
+    query = parse_qsl(parts.query, keep_blank_values=True)
+
+    for site, domain, pattern in VIDEO_ID_PATTERNS:
+        if host == domain or host.endswith("." + domain):
+            match = pattern.search(path)
+            if match:
+                return f"{site}:{match.group(1)}"
+    if host == "youtube.com" and path == "/watch":
+        video_id = dict(query).get("v")
+        if video_id:
+            return f"youtube:{video_id}"
+
+    query = sorted((k, v) for k, v in query if k not in TRACKING_PARAMS and not k.startswith("utm_"))
+    return host + path + ("?" + urlencode(query) if query else "")
+
+
+def extra_hashtags(video, hashtags):
+    # The hashtags not yet on video, compared case-insensitively.
+    table = video.table
+    have = set(video.tag_ids)
+    extra = []
+    for tag in hashtags:
+        tag_id = table.tag_of[table.intern(tag)]
+        if tag_id not in have:
+            have.add(tag_id)
+            extra.append(tag)
+    return extra
+
+
+# === Video records ===
+# Every loaded video is held in memory by the list view and the indexes, so
+# records are kept small: a slotted object instead of a dict, with hashtags
+# interned in its store's TagTable. Each distinct spelling ("#GZ", "#gz") is
+# stored once under an integer id and mapped to the id of its normalized tag,
+# so a record holds just a tuple of spelling ids and nothing is lowercased
+# again after a video is created. city and category are worked out once for
+# /list. Every store has a table of its own, which goes away with the store
+# when its shard is evicted; TAGS only holds the spellings of videos built
+# outside any store, which stores re-intern when they are given one.
+class TagTable:
+    def __init__(self):
+        self.names = []
+        self.ids = {}
+        self.spellings = []
+        self.tag_of = []
+        self._spelling_ids = {}
+
+    def intern(self, spelling):
+        # Returns the id of spelling, adding it and its tag if new.
+        spelling_id = self._spelling_ids.get(spelling)
+        if spelling_id is None:
+            name = normalize_tag(spelling)
+            tag_id = self.ids.get(name)
+            if tag_id is None:
+                tag_id = self.ids[name] = len(self.names)
+                self.names.append(name)
+            spelling_id = self._spelling_ids[spelling] = len(self.spellings)
+            self.spellings.append(spelling)
+            self.tag_of.append(tag_id)
+        return spelling_id
+
+
+TAGS = TagTable()
+UNKNOWN_GROUP = "#unknown"
+
+
+class Video:
+    # Records are never changed once stored, apart from the store setting
+    # id and version when it stores them, slot, its key for the video
+    # (TagIndex slot or SQLite row id), and title and author once they have
+    # been fetched; edits store a new record.
+    __slots__ = ("url", "key", "table", "tags", "city", "category", "slot", "id", "version", "title", "author")
+
+    def __init__(self, url, hashtags=(), key=None, slot=None, video_id=None, version=1, title=None, author=None,
+                 table=TAGS):
+        self.url = url
+        self.key = key or canonical_url(url)
+        self.slot = slot
+        self.id = video_id
+        self.version = version
+        self.title = title
+        self.author = author
+        self.table = table
+        self._set_tags(tuple(table.intern(tag) for tag in hashtags))
+
+    @classmethod
+    def from_spelling_ids(cls, table, url, key, tags, video_id=None, version=1, title=None, author=None):
+        # For loaders that have interned the hashtags in table already.
+        video = cls.__new__(cls)
+        video.url = url
+        video.key = key
+        video.table = table
+        video.slot = None
+        video.id = video_id
+        video.version = version
+        video.title = title
+        video.author = author
+        video._set_tags(tags)
+        return video
+
+    def _set_tags(self, tags):
+        self.tags = tags
+        table_names = self.table.names
+        tag_of = self.table.tag_of
+        names = [table_names[tag_of[spelling_id]] for spelling_id in tags]
+        self.city = next((name for name in names if name in CITY_TAGS), UNKNOWN_GROUP)
+        self.category = next((name for name in names if name in CATEGORY_TAGS), UNKNOWN_GROUP)
+
+    @property
+    def hashtags(self):
+        spellings = self.table.spellings
+        return tuple(spellings[spelling_id] for spelling_id in self.tags)
+
+    @property
+    def tag_names(self):
+        names = self.table.names
+        return [names[tag_id] for tag_id in self.tag_ids]
+
+    @property
+    def tag_ids(self):
+        # Distinct normalized tags, in the order they were first sent.
+        tag_of = self.table.tag_of
+        return tuple(dict.fromkeys(tag_of[spelling_id] for spelling_id in self.tags))
+
+    @classmethod
+    def from_dict(cls, data, table=TAGS):
+        return cls(
+            data["url"], data.get("hashtags", ()), data.get("key"),
+            video_id=data.get("id"), version=data.get("version", 1),
+            title=data.get("title"), author=data.get("author"), table=table,
+        )
+
+    def to_dict(self):
+        data = {
+            "url": self.url, "hashtags": list(self.hashtags), "key": self.key,
+            "id": self.id, "version": self.version,
+        }
+        if self.title is not None:
+            data["title"] = self.title
+            data["author"] = self.author
+        return data
+
+    def with_hashtags(self, extra):
+        return Video(
+            self.url, self.hashtags + tuple(extra), self.key, title=self.title, author=self.author, table=self.table
+        )
+
+
+def as_video(video, table):
+    # video as a record interned in table.
+    if not isinstance(video, Video):
+        return Video.from_dict(video, table)
+    if video.table is table:
+        return video
+    return Video(
+        video.url, video.hashtags, video.key, video_id=video.id, version=video.version,
+        title=video.title, author=video.author, table=table,
+    )
+
+
+VIDEO_ID = attrgetter("id")
+
+
+def bisect_videos(videos, value, key):
+    # bisect.bisect_left(videos, value, key=key), whose key= needs Python 3.10.
+    lo, hi = 0, len(videos)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if key(videos[mid]) < value:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def check_version(video, video_id, expected_version):
+    if video is None:
+        raise VersionConflict(f"Video {video_id} no longer exists")
+    if expected_version is not None and video.version != expected_version:
+        raise VersionConflict(
+            f"Video {video_id} is at version {video.version}, not {expected_version}"
+        )
+
+
+def video_decoder(table):
+    # A json object_hook that builds records while parsing, so a snapshot is
+    # never held as dicts in full.
+    def decode(obj):
+        return Video.from_dict(obj, table) if "url" in obj else obj
+    return decode
+
+
+# === Binary snapshots ===
+# JSON backend snapshots are written as a header (magic, format version,
+# journal sequence number, next video id) followed by columns: the distinct
+# hashtag spellings, then every video's url, canonical key, title, author,
+# spelling indexes, id and version. A column is a little-endian item count
+# and an array of fixed-size integers; a column of strings is an int32
+# length per value (-1 for None) followed by all the values as one UTF-8
+# blob. Loading reads each column with one frombytes() and one decode() and
+# interns each spelling once, instead of decoding a JSON object per video.
+#
+# Snapshots written before this format (and the old db.json) are JSON and
+# still load; the next compaction rewrites them. Videos loaded without an id
+# get one (see JsonStore._load).
+SNAPSHOT_MAGIC = b"GZVS"
+SNAPSHOT_VERSION = 4
+SNAPSHOT_HEADER = struct.Struct("<4sHQ")
+SNAPSHOT_NEXT_ID = struct.Struct("<Q")
+COLUMN_COUNT = struct.Struct("<Q")
+
+
+def _pack_ints(typecode, values):
+    column = array(typecode, values)
+    if sys.byteorder == "big":
+        column.byteswap()
+    return COLUMN_COUNT.pack(len(column)) + column.tobytes()
+
+
+def _unpack_ints(typecode, data, offset):
+    (count,) = COLUMN_COUNT.unpack_from(data, offset)
+    offset += COLUMN_COUNT.size
+    column = array(typecode)
+    end = offset + count * column.itemsize
+    column.frombytes(data[offset:end])
+    if sys.byteorder == "big":
+        column.byteswap()
+    return column, end
+
+
+def _pack_strings(values):
+    lengths = _pack_ints("i", [-1 if value is None else len(value) for value in values])
+    text = "".join(value for value in values if value is not None).encode("utf-8", "surrogatepass")
+    return lengths + COLUMN_COUNT.pack(len(text)) + text
+
+
+def _unpack_strings(data, offset):
+    lengths, offset = _unpack_ints("i", data, offset)
+    (size,) = COLUMN_COUNT.unpack_from(data, offset)
+    offset += COLUMN_COUNT.size
+    text = str(data[offset:offset + size], "utf-8", "surrogatepass")
+    values = []
+    position = 0
+    for length in lengths:
+        if length < 0:
+            values.append(None)
+        else:
+            values.append(text[position:position + length])
+            position += length
+    return values, offset + size
+
+
+def encode_snapshot(videos, seq, next_id):
+    spellings = {}
+    tag_counts = []
+    tags = []
+    for video in videos:
+        tag_counts.append(len(video.tags))
+        table_spellings = video.table.spellings
+        tags.extend(spellings.setdefault(table_spellings[spelling_id], len(spellings)) for spelling_id in video.tags)
+    return b"".join([
+        SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, seq),
+        SNAPSHOT_NEXT_ID.pack(next_id),
+        _pack_strings(list(spellings)),
+        _pack_strings([video.url for video in videos]),
+        _pack_strings([video.key for video in videos]),
+        _pack_strings([video.title for video in videos]),
+        _pack_strings([video.author for video in videos]),
+        _pack_ints("i", tag_counts),
+        _pack_ints("i", tags),
+        _pack_ints("q", [video.id for video in videos]),
+        _pack_ints("q", [video.version for video in videos]),
+    ])
+
+
+def _decode_columns(data):
+    offset = SNAPSHOT_HEADER.size
+    (next_id,) = SNAPSHOT_NEXT_ID.unpack_from(data, offset)
+    offset += SNAPSHOT_NEXT_ID.size
+    spellings, offset = _unpack_strings(data, offset)
+    urls, offset = _unpack_strings(data, offset)
+    keys, offset = _unpack_strings(data, offset)
+    titles, offset = _unpack_strings(data, offset)
+    authors, offset = _unpack_strings(data, offset)
+    tag_counts, offset = _unpack_ints("i", data, offset)
+    flat_tags, offset = _unpack_ints("i", data, offset)
+    ids, offset = _unpack_ints("q", data, offset)
+    versions, offset = _unpack_ints("q", data, offset)
+    ends = itertools.accumulate(tag_counts)
+    tags = [flat_tags[end - count:end] for count, end in zip(tag_counts, ends)]
+    return next_id, spellings, urls, keys, tags, ids, versions, titles, authors
+
+
+def read_snapshot(path, table):
+    # Returns (videos, seq, next_id) from a binary or JSON snapshot, with the
+    # hashtags interned in table; next_id is None if the snapshot doesn't
+    # record it.
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data.startswith(SNAPSHOT_MAGIC):
+        snapshot = json.loads(data, object_hook=video_decoder(table))
+        return snapshot.get("videos", []), snapshot.get("seq", 0), None
+    _, version, seq = SNAPSHOT_HEADER.unpack_from(data)
+    if version != SNAPSHOT_VERSION:
+        raise ValueError(f"Unsupported snapshot version {version} in {path}")
+    next_id, spellings, urls, keys, tags, ids, versions, titles, authors = _decode_columns(memoryview(data))
+    spelling_ids = [table.intern(spelling) for spelling in spellings]
+    videos = [
+        Video.from_spelling_ids(
+            table, url, key, tuple(spelling_ids[i] for i in video_tags), video_id, video_version, title, author
+        )
+        for url, key, video_tags, video_id, video_version, title, author
+        in zip(urls, keys, tags, ids, versions, titles, authors)
+    ]
+    return videos, seq, next_id
+
+
+# === Group commit writer thread ===
+# Writes are handed to a worker thread through a queue so that no file I/O
+# happens on the event loop. Items that arrive within the group commit window
+# are written together and made durable with a single sync; each caller gets
+# a Future that resolves once its item is durable.
+class GroupCommitWriter(threading.Thread):
+    def __init__(self, name, window=GROUP_COMMIT_WINDOW):
+        super().__init__(name=name, daemon=True)
+        self.window = window
+        self.queue = queue.Queue()
+
+    def submit(self, item):
+        future = Future()
+        self.queue.put((item, future))
+        return future
+
+    def stop(self):
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        self.open()
+        running = True
+        while running:
+            item = self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.window
+            while True:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+            self._commit(batch)
+        self.close()
+
+    def _commit(self, batch):
+        started = time.perf_counter()
+        try:
+            for item, _ in batch:
+                self.write(item)
+            self.sync()
+            metrics.STORAGE_COMMIT_SECONDS.observe(time.perf_counter() - started, self.name)
+            metrics.STORAGE_COMMIT_WRITES.inc(self.name, amount=len(batch))
+        except Exception as e:
+            logging.exception(f"{self.name} failed to commit {len(batch)} writes")
+            self.rollback()
+            for _, future in batch:
+                future.set_exception(e)
+        else:
+            for _, future in batch:
+                future.set_result(None)
+
+    # Hooks, all called on the writer thread.
+    def open(self):
+        pass
+
+    def write(self, item):
+        raise NotImplementedError
+
+    def sync(self):
+        raise NotImplementedError
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+# === Hashtag Index ===
+class TagIndex:
+    # Maps a tag id to the slots of the videos carrying it. Slots grow
+    # monotonically and an edited video keeps its slot, so sorting a result
+    # set by slot gives back insertion order. A posting is a sorted
+    # array('I') rather than a set: 4 bytes a slot instead of the ~40 a set
+    # entry takes, and a new video's slot is simply appended.
+    PROBE_RATIO = 8
+
+    def __init__(self, table):
+        self.table = table
+        self.postings = {}
+        # Every tag in postings, sorted, for prefix queries.
+        self.tags = []
+        # Video by slot; None once removed.
+        self.videos = []
+
+    def add(self, video, slot=None):
+        if slot is None:
+            slot = len(self.videos)
+            self.videos.append(video)
+        else:
+            self.videos[slot] = video
+        video.slot = slot
+        for tag_id in video.tag_ids:
+            posting = self.postings.get(tag_id)
+            if posting is None:
+                posting = self.postings[tag_id] = array("I")
+                bisect.insort(self.tags, self.table.names[tag_id])
+            if not posting or posting[-1] < slot:
+                posting.append(slot)
+            else:
+                bisect.insort(posting, slot)
+        return slot
+
+    def add_all(self, videos):
+        # add() for each of videos, with every posting extended in one go.
+        new = {}
+        for video in videos:
+            slot = video.slot = len(self.videos)
+            self.videos.append(video)
+            for tag_id in video.tag_ids:
+                new.setdefault(tag_id, []).append(slot)
+        for tag_id, slots in new.items():
+            posting = self.postings.get(tag_id)
+            if posting is None:
+                posting = self.postings[tag_id] = array("I")
+                bisect.insort(self.tags, self.table.names[tag_id])
+            posting.extend(slots)
+
+    def remove(self, video):
+        slot = video.slot
+        self.videos[slot] = None
+        for tag_id in video.tag_ids:
+            posting = self.postings[tag_id]
+            del posting[bisect.bisect_left(posting, slot)]
+            if not posting:
+                del self.postings[tag_id]
+                del self.tags[bisect.bisect_left(self.tags, self.table.names[tag_id])]
+        return slot
+
+    # --- Query index interface (see query.py) ---
+    def count(self, tag):
+        return len(self.posting(tag))
+
+    def posting(self, tag):
+        return self.postings.get(self.table.ids.get(tag), ())
+
+    def restrict(self, tag, candidates, count):
+        posting = self.posting(tag)
+        if len(candidates) * self.PROBE_RATIO >= count:
+            return candidates.intersection(posting)
+        # Few candidates against a common tag: binary search for each one.
+        found = set()
+        for slot in candidates:
+            i = bisect.bisect_left(posting, slot)
+            if i < len(posting) and posting[i] == slot:
+                found.add(slot)
+        return found
+
+    def tags_with_prefix(self, prefix):
+        lo = bisect.bisect_left(self.tags, prefix)
+        hi = bisect.bisect_left(self.tags, prefix + "\U0010ffff")
+        return self.tags[lo:hi]
+
+    def universe(self):
+        return {slot for slot, video in enumerate(self.videos) if video is not None}
+
+
+# === /list view ===
+def group_key(video):
+    # From every spelling rather than tag_ids, so a tag sent twice
+    # ("#gz #GZ") still shows twice in the group name.
+    table = video.table
+    names = [table.names[table.tag_of[spelling_id]] for spelling_id in video.tags]
+    other_tags = [tag for tag in names if tag not in [video.city, video.category]]
+    other_tags_key = " ".join(sorted(other_tags)) if other_tags else "#none"
+    return video.city, video.category, other_tags_key
+
+
+VIDEO_SLOT = attrgetter("slot")
+
+
+class ListView:
+    # The city -> category -> tags grouping behind /list, maintained as videos
+    # come and go instead of being rebuilt per call. Each tag group's rendered
+    # lines are cached, and every node caches the smallest key below it, which
+    # orders siblings the same way a fresh pass over the collection would. A
+    # mutation drops only the cache entries on the path to the group it
+    # touched. A tag group is a list of videos sorted by slot.
+    def __init__(self):
+        self.root = {}
+        self._min_keys = {}
+        self._lines = {}
+
+    def __bool__(self):
+        return bool(self.root)
+
+    def add(self, video):
+        city, category, tags = path = group_key(video)
+        videos = self.root.setdefault(city, {}).setdefault(category, {}).setdefault(tags, [])
+        videos.insert(bisect_videos(videos, video.slot, VIDEO_SLOT), video)
+        self._invalidate(path)
+
+    def remove(self, video):
+        city, category, tags = path = group_key(video)
+        categories = self.root[city]
+        groups = categories[category]
+        videos = groups[tags]
+        del videos[bisect_videos(videos, video.slot, VIDEO_SLOT)]
+        if not videos:
+            del groups[tags]
+            if not groups:
+                del categories[category]
+                if not categories:
+                    del self.root[city]
+        self._invalidate(path)
+
+    def touch(self, video):
+        # video's line changed but not its group.
+        self._lines.pop(group_key(video), None)
+
+    def _invalidate(self, path):
+        self._lines.pop(path, None)
+        for depth in range(len(path) + 1):
+            self._min_keys.pop(path[:depth], None)
+
+    def _min_key(self, path, node):
+        key = self._min_keys.get(path)
+        if key is None:
+            if len(path) == 3:
+                key = node[0].slot
+            else:
+                key = min(self._min_key(path + (name,), child) for name, child in node.items())
+            self._min_keys[path] = key
+        return key
+
+    def _children(self, path, node):
+        return sorted(node.items(), key=lambda item: self._min_key(path + (item[0],), item[1]))
+
+    def _group_lines(self, path, videos):
+        lines = self._lines.get(path)
+        if lines is None:
+            lines = [f"    Tags: {path[2]}"]
+            lines += [f"      {format_video(video)}" for video in videos]
+            lines.append("")  # Add space between tag groups
+            self._lines[path] = lines
+        return lines
+
+    def iter_lines(self, start=0):
+        # Yields the /list lines from line `start` onwards. Tag groups before
+        # `start` are skipped by their size without being rendered.
+        skip = start
+        for city, categories in self._children((), self.root):
+            if skip:
+                skip -= 1
+            else:
+                yield f"City: {city}"
+            for category, groups in self._children((city,), categories):
+                if skip:
+                    skip -= 1
+                else:
+                    yield f"  Category: {category}"
+                for tags, videos in self._children((city, category), groups):
+                    size = len(videos) + 2
+                    if skip >= size:
+                        skip -= size
+                        continue
+                    yield from self._group_lines((city, category, tags), videos)[skip:]
+                    skip = 0
+                if skip:
+                    skip -= 1
+                else:
+                    yield ""  # Add space between categories
+            if skip:
+                skip -= 1
+            else:
+                yield ""  # Add space between cities
+
+    def headers_at(self, start):
+        # The City:/Category:/Tags: lines above line `start` that it falls
+        # under, so a page starting there can repeat them.
+        skip = start
+        for city, categories in self._children((), self.root):
+            headers = [f"City: {city}"]
+            if not skip:
+                return []
+            skip -= 1
+            for category, groups in self._children((city,), categories):
+                if not skip:
+                    return headers
+                skip -= 1
+                headers.append(f"  Category: {category}")
+                for tags, videos in self._children((city, category), groups):
+                    size = len(videos) + 2
+                    if skip >= size:
+                        skip -= size
+                        continue
+                    if 0 < skip <= len(videos):
+                        return headers + self._group_lines((city, category, tags), videos)[:1]
+                    return headers
+                if not skip:
+                    return headers
+                skip -= 1
+                headers.pop()
+            if not skip:
+                return headers
+            skip -= 1
+        return []
+
+    def render(self):
+        return "\n".join(self.iter_lines()).strip()
+
+
+# === Duplicate detection ===
+# Both backends keep a hash index from canonical key to the stored video
+# (self._by_key) and persist the key with each video, so the index is
+# rebuilt on restart without re-parsing URLs. add()/add_many() consult it
+# first and, for a video that is already stored, merge the new hashtags into
+# the stored entry instead of creating a second record.
+class DedupingStore:
+    def add(self, video):
+        # Returns True if the video was new, False if it was merged.
+        self._ensure_indexes()
+        video = as_video(video, self.tag_table)
+        existing = self._by_key.get(video.key)
+        if existing is None:
+            self._insert(video)
+            return True
+        self._merge(existing, video.hashtags)
+        return False
+
+    def add_many(self, videos):
+        # Returns (number of new videos, number merged into existing ones).
+        self._ensure_indexes()
+        new = {}
+        merged = 0
+        for video in (as_video(video, self.tag_table) for video in videos):
+            key = video.key
+            if key in new:
+                new[key] = new[key].with_hashtags(extra_hashtags(new[key], video.hashtags))
+                merged += 1
+            elif key in self._by_key:
+                self._merge(self._by_key[key], video.hashtags)
+                merged += 1
+            else:
+                new[key] = video
+        if new:
+            self._insert_many(list(new.values()))
+        return len(new), merged
+
+
+# === JSON backend: snapshot + append-only journal ===
+# The snapshot is a binary dump of the collection (see read_snapshot) with the
+# sequence number of the last journal record folded into it. Every mutation appends a
+# single JSON line to the journal, so the cost of a write does not depend on
+# how many videos are stored. Once enough records pile up the journal is
+# rotated and a background thread writes a fresh snapshot.
+class JsonStore(DedupingStore):
+    def __init__(self, path, compact_every=COMPACT_EVERY):
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.compact_every = compact_every
+        self.tag_table = TagTable()
+        # Kept in id order: ids only grow and edits keep theirs.
+        self.videos = []
+        self.seq = 0
+        self._next_id = 1
+        self._pending = 0
+        self._last_write = None
+        self._load()
+        self._tag_index = None
+        self._list_view = None
+        self._by_key = None
+        self._tag_dictionary = None
+        self._search_cache = ResultCache()
+        self._writer = JournalWriter(self)
+        self._writer.start()
+
+    # --- Loading ---
+    def _load(self):
+        snapshot_seq = 0
+        if os.path.exists(self.path):
+            videos, snapshot_seq, next_id = read_snapshot(self.path, self.tag_table)
+            self._next_id = next_id or 1
+            for video in videos:
+                self._append_loaded(video)
+        else:
+            # Start with an empty snapshot so the collection's file exists
+            # from its first use on.
+            self._write_snapshot([], 0, 1)
+        self.seq = snapshot_seq
+
+        # A journal left over from an interrupted compaction is replayed first;
+        # records already folded into the snapshot are skipped by sequence.
+        for journal in (self.journal_path + ".old", self.journal_path):
+            if not os.path.exists(journal):
+                continue
+            decode = video_decoder(self.tag_table)
+            with open(journal, "r+b") as f:
+                good_bytes = 0
+                for line in f:
+                    try:
+                        record = json.loads(line, object_hook=decode)
+                    except json.JSONDecodeError:
+                        record = None
+                    if record is None or not line.endswith(b"\n"):
+                        # Torn final write from a crash; everything before it is
+                        # intact. Cut it off so new records start on a clean line.
+                        logging.warning(f"Dropping truncated journal record in {journal}")
+                        f.truncate(good_bytes)
+                        break
+                    good_bytes += len(line)
+                    if record["seq"] <= snapshot_seq:
+                        continue
+                    self._apply(record)
+                    self.seq = record["seq"]
+                    self._pending += 1
+
+        # Fold a leftover rotated journal into the snapshot right away so the
+        # next rotation cannot overwrite it.
+        if os.path.exists(self.journal_path + ".old"):
+            self._write_snapshot(list(self.videos), self.seq, self._next_id)
+
+    def _append_loaded(self, video):
+        # Videos from before ids were stored get the next one, in the same
+        # order on every load, so the ids later journal records use match.
+        if video.id is None:
+            video.id = self._next_id
+        self._next_id = max(self._next_id, video.id + 1)
+        self.videos.append(video)
+
+    def _apply(self, record):
+        op = record["op"]
+        if op == "add":
+            self._append_loaded(record["video"])
+        elif op == "add_many":
+            for video in record["videos"]:
+                self._append_loaded(video)
+        elif op == "edit":
+            self.videos[self._position(record["id"])] = record["video"]
+        elif op == "delete":
+            del self.videos[self._position(record["id"])]
+        elif op == "meta":
+            video = self.find(record["id"])
+            if video is not None:
+                video.title = record["title"]
+                video.author = record["author"]
+        else:
+            raise ValueError(f"Unknown journal op: {op}")
+
+    # --- Indexes ---
+    # TagIndex hands out the slots that order the list view, so the list view
+    # builds it first.
+    @property
+    def tag_index(self):
+        if self._tag_index is None:
+            self._tag_index = TagIndex(self.tag_table)
+            self._tag_index.add_all(self.videos)
+        return self._tag_index
+
+    @property
+    def list_view(self):
+        if self._list_view is None:
+            self.tag_index
+            self._list_view = ListView()
+            for video in self.videos:
+                self._list_view.add(video)
+        return self._list_view
+
+    def _ensure_indexes(self):
+        self.list_view
+        if self._by_key is None:
+            self._by_key = {}
+            for video in self.videos:
+                self._by_key.setdefault(video.key, video)
+
+    # --- Reads ---
+    def count(self):
+        return len(self.videos)
+
+    def get(self, index):
+        if 0 <= index < len(self.videos):
+            return self.videos[index]
+        return None
+
+    def all(self):
+        return iter(self.videos)
+
+    def _position(self, video_id):
+        index = bisect_videos(self.videos, video_id, VIDEO_ID)
+        if index < len(self.videos) and self.videos[index].id == video_id:
+            return index
+        return None
+
+    def find(self, video_id):
+        index = self._position(video_id)
+        return self.videos[index] if index is not None else None
+
+    def complete_tags(self, prefix, limit=10):
+        if self._tag_dictionary is None:
+            names = self.tag_table.names
+            self._tag_dictionary = TagDictionary(
+                {names[tag_id]: len(posting) for tag_id, posting in self.tag_index.postings.items()}
+            )
+        return self._tag_dictionary.complete(prefix, limit)
+
+    def search(self, query, start=0):
+        key = format_query(query)
+        slots = self._search_cache.get(key)
+        if slots is None:
+            slots = evaluate(query, self.tag_index)
+            self._search_cache.put(key, slots)
+        videos = self.tag_index.videos
+        return (videos[slots[i]] for i in range(start, len(slots)))
+
+    # --- Mutations ---
+    # Mutations apply to memory immediately and return a Future for the
+    # journal write; await flushed() before confirming anything to the user.
+    def _assign_id(self, video):
+        video.id = self._next_id
+        video.version = 1
+        self._next_id += 1
+
+    def _insert(self, video):
+        self._assign_id(video)
+        self.videos.append(video)
+        self._index(video)
+        self._append({"op": "add", "video": video})
+
+    def _insert_many(self, videos):
+        for video in videos:
+            self._assign_id(video)
+            self._index(video)
+        self.videos.extend(videos)
+        self._append({"op": "add_many", "videos": videos})
+
+    def _merge(self, existing, hashtags):
+        extra = extra_hashtags(existing, hashtags)
+        if extra:
+            self.replace(existing.id, existing.with_hashtags(extra))
+
+    def replace(self, video_id, video, expected_version=None):
+        self._ensure_indexes()
+        index = self._position(video_id)
+        old_video = self.videos[index] if index is not None else None
+        check_version(old_video, video_id, expected_version)
+        video = as_video(video, self.tag_table)
+        video.id = video_id
+        video.version = old_video.version + 1
+        self._unindex(old_video)
+        self._index(video, slot=self.tag_index.remove(old_video))
+        self.videos[index] = video
+        return self._append({"op": "edit", "id": video_id, "video": video})
+
+    def delete(self, video_id, expected_version=None):
+        self._ensure_indexes()
+        index = self._position(video_id)
+        check_version(self.videos[index] if index is not None else None, video_id, expected_version)
+        removed = self.videos.pop(index)
+        self._unindex(removed)
+        self.tag_index.remove(removed)
+        self._append({"op": "delete", "id": video_id})
+        return removed
+
+    def set_metadata(self, key, metadata):
+        self._ensure_indexes()
+        video = self._by_key.get(key)
+        if video is None:
+            return None
+        video.title = metadata.get("title")
+        video.author = metadata.get("author")
+        self.list_view.touch(video)
+        return self._append({"op": "meta", "id": video.id, "title": video.title, "author": video.author})
+
+    def _index(self, video, slot=None):
+        self.tag_index.add(video, slot)
+        self.list_view.add(video)
+        self._by_key.setdefault(video.key, video)
+        if self._tag_dictionary is not None:
+            self._tag_dictionary.add(video.tag_names)
+        self._search_cache.clear()
+
+    def _unindex(self, video):
+        self.list_view.remove(video)
+        if self._by_key.get(video.key) is video:
+            del self._by_key[video.key]
+        if self._tag_dictionary is not None:
+            self._tag_dictionary.remove(video.tag_names)
+        self._search_cache.clear()
+
+    def _append(self, record):
+        self.seq += 1
+        record["seq"] = self.seq
+        self._last_write = self._writer.submit(json.dumps(record, default=Video.to_dict) + "\n")
+        self._pending += 1
+        if self._pending >= self.compact_every:
+            self.compact()
+        return self._last_write
+
+    async def flushed(self):
+        if self._last_write is not None:
+            await asyncio.wrap_future(self._last_write)
+
+    # --- Compaction ---
+    def compact(self):
+        # The writer rotates the journal in queue order, so the snapshot taken
+        # here covers exactly the records submitted before it. Edits replace
+        # Video records rather than mutating them, so a shallow copy of the
+        # list is a consistent view.
+        self._pending = 0
+        self._writer.submit(Compaction(list(self.videos), self.seq, self._next_id))
+
+    def _write_snapshot(self, videos, seq, next_id):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(encode_snapshot(videos, seq, next_id))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        if os.path.exists(self.journal_path + ".old"):
+            os.remove(self.journal_path + ".old")
+
+    def _compact(self, videos, seq, next_id):
+        self._write_snapshot(videos, seq, next_id)
+        logging.info(f"Compacted {len(videos)} videos into {self.path} at seq {seq}")
+
+    def close(self):
+        # Drains every queued record before returning.
+        self._writer.stop()
+
+
+class Compaction:
+    def __init__(self, videos, seq, next_id):
+        self.videos = videos
+        self.seq = seq
+        self.next_id = next_id
+
+
+class JournalWriter(GroupCommitWriter):
+    def __init__(self, store):
+        super().__init__(name="journal-writer")
+        self.store = store
+        self._journal = None
+        self._compaction = None
+
+    def open(self):
+        self._journal = open(self.store.journal_path, "a", encoding="utf-8")
+
+    def write(self, item):
+        if isinstance(item, Compaction):
+            self._rotate(item)
+        else:
+            self._journal.write(item)
+
+    def sync(self):
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def close(self):
+        self._journal.close()
+        if self._compaction:
+            self._compaction.join()
+
+    def _rotate(self, compaction):
+        # Never clobber a rotated journal whose snapshot is still being written.
+        if self._compaction:
+            self._compaction.join()
+        self.sync()
+        self._journal.close()
+        os.replace(self.store.journal_path, self.store.journal_path + ".old")
+        self._journal = open(self.store.journal_path, "a", encoding="utf-8")
+        self._compaction = threading.Thread(
+            target=self.store._compact,
+            args=(compaction.videos, compaction.seq, compaction.next_id),
+            name="journal-compaction",
+            daemon=True,
+        )
+        self._compaction.start()
+
+
+# === SQLite backend ===
+# Videos, tags and the video/tag relation live in normalized tables so that
+# hashtag lookups are index seeks instead of scans. Reads go through a
+# connection owned by the event loop thread; mutations are queued to a writer
+# thread with its own connection and committed in groups. WAL mode lets the
+# two work side by side. With synchronous=FULL every commit syncs the WAL, so
+# a group is durable once committed (NORMAL only syncs at checkpoints, and a
+# power loss could undo commits flushed() had already reported). A video's
+# id is its row id; the counters table remembers the next one, so deleting
+# the newest video doesn't free its id.
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS videos (
+    id INTEGER PRIMARY KEY,
+    url TEXT NOT NULL,
+    hashtags TEXT NOT NULL,
+    canonical TEXT,
+    version INTEGER NOT NULL DEFAULT 1,
+    title TEXT,
+    author TEXT
+);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tags (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS video_tags (
+    tag_id INTEGER NOT NULL REFERENCES tags(id),
+    video_id INTEGER NOT NULL REFERENCES videos(id) ON DELETE CASCADE,
+    PRIMARY KEY (tag_id, video_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS video_tags_by_video ON video_tags(video_id);
+CREATE INDEX IF NOT EXISTS videos_by_url ON videos(url);
+CREATE INDEX IF NOT EXISTS videos_by_canonical ON videos(canonical);
+"""
+
+
+def _connect(path, check_same_thread=True):
+    conn = sqlite3.connect(path, check_same_thread=check_same_thread)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=FULL")
+    conn.execute("PRAGMA foreign_keys=ON")
+    return conn
+
+
+VIDEO_COLUMNS = "id, url, hashtags, canonical, version, title, author"
+
+
+def _row_to_video(row, table):
+    return Video(
+        row[1], row[2].split(), row[3], slot=row[0], video_id=row[0], version=row[4], title=row[5], author=row[6],
+        table=table,
+    )
+
+
+def _insert_video(conn, video, video_id=None):
+    cur = conn.execute(
+        "INSERT INTO videos (id, url, hashtags, canonical, version, title, author) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (video_id, video.url, " ".join(video.hashtags), video.key, video.version, video.title, video.author),
+    )
+    _insert_tags(conn, cur.lastrowid, video.tag_names)
+
+
+def _insert_tags(conn, video_id, names):
+    for tag in names:
+        conn.execute("INSERT OR IGNORE INTO tags (name) VALUES (?)", (tag,))
+        conn.execute(
+            "INSERT INTO video_tags (tag_id, video_id) "
+            "SELECT id, ? FROM tags WHERE name = ?",
+            (video_id, tag),
+        )
+
+
+def _update_video(conn, video_id, video):
+    conn.execute(
+        "UPDATE videos SET url = ?, hashtags = ?, canonical = ?, version = ?, title = ?, author = ? WHERE id = ?",
+        (video.url, " ".join(video.hashtags), video.key, video.version, video.title, video.author, video_id),
+    )
+    conn.execute("DELETE FROM video_tags WHERE video_id = ?", (video_id,))
+    _insert_tags(conn, video_id, video.tag_names)
+
+
+def _update_metadata(conn, video_id, title, author):
+    conn.execute("UPDATE videos SET title = ?, author = ? WHERE id = ?", (title, author, video_id))
+
+
+def _delete_video(conn, video_id):
+    conn.execute("DELETE FROM videos WHERE id = ?", (video_id,))
+    conn.execute(
+        "INSERT INTO counters (name, value) VALUES ('next_video_id', ?) "
+        "ON CONFLICT (name) DO UPDATE SET value = MAX(value, excluded.value)",
+        (video_id + 1,),
+    )
+
+
+class SqliteTagIndex:
+    # The query.py index interface over the video_tags table; the tags
+    # table's UNIQUE index is the sorted tag dictionary.
+    PROBE_RATIO = 8
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def count(self, tag):
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM video_tags WHERE tag_id = (SELECT id FROM tags WHERE name = ?)", (tag,)
+        ).fetchone()[0]
+
+    def posting(self, tag):
+        rows = self.conn.execute(
+            "SELECT video_id FROM video_tags WHERE tag_id = (SELECT id FROM tags WHERE name = ?)", (tag,)
+        )
+        return {row[0] for row in rows}
+
+    def restrict(self, tag, candidates, count):
+        if len(candidates) * self.PROBE_RATIO >= count:
+            return candidates & self.posting(tag)
+        # Few candidates against a common tag: look each one up in the
+        # (tag_id, video_id) primary key instead of reading the whole posting.
+        candidates = list(candidates)
+        found = set()
+        for i in range(0, len(candidates), SQL_CHUNK_SIZE):
+            chunk = candidates[i:i + SQL_CHUNK_SIZE]
+            rows = self.conn.execute(
+                "SELECT video_id FROM video_tags WHERE tag_id = (SELECT id FROM tags WHERE name = ?) "
+                f"AND video_id IN ({', '.join('?' * len(chunk))})",
+                (tag, *chunk),
+            )
+            found.update(row[0] for row in rows)
+        return found
+
+    def tags_with_prefix(self, prefix):
+        rows = self.conn.execute(
+            "SELECT name FROM tags WHERE name >= ? AND name < ? "
+            "AND EXISTS (SELECT 1 FROM video_tags WHERE tag_id = tags.id) ORDER BY name",
+            (prefix, prefix + "\U0010ffff"),
+        )
+        return [row[0] for row in rows]
+
+    def universe(self):
+        return {row[0] for row in self.conn.execute("SELECT id FROM videos")}
+
+
+class SqliteStore(DedupingStore):
+    def __init__(self, path, legacy_json_path=None):
+        self.path = path
+        # Only ever used from the event loop, but ShardedStore may close it
+        # from the thread that drains an evicted shard.
+        self.conn = _connect(path, check_same_thread=False)
+        self.tag_table = TagTable()
+        self._last_write = None
+        self._migrate(legacy_json_path)
+        self.tag_index = SqliteTagIndex(self.conn)
+        self._search_cache = ResultCache()
+        # Search results are only cached while every submitted write is
+        # committed, since queries read the database rather than memory.
+        self._generation = 0
+        self._committed = 0
+        # Row ids are handed out here rather than by the writer so the list
+        # view can key new videos before their INSERT is committed.
+        self._count, self._next_id = self.conn.execute(
+            "SELECT COUNT(*), MAX(COALESCE(MAX(id), 0) + 1, "
+            "COALESCE((SELECT value FROM counters WHERE name = 'next_video_id'), 1)) FROM videos"
+        ).fetchone()
+        # Filled from one scan of the table on first use. Every mutation
+        # builds them first, so the scan never misses an uncommitted write.
+        # _by_id has the latest version of every video, committed or not, in
+        # id order (an edit keeps its video's place), so once it is built
+        # get() and all() read it rather than the database.
+        self._list_view = None
+        self._by_key = None
+        self._by_id = None
+        self._tag_dictionary = None
+        self._writer = SqliteWriter(path)
+        self._writer.start()
+
+    def _migrate(self, legacy_json_path):
+        (version,) = self.conn.execute("PRAGMA user_version").fetchone()
+        if version >= SCHEMA_VERSION:
+            return
+        with self.conn:
+            # Creating the tables and importing db.json is one transaction,
+            # so a crash part way leaves user_version 0 and no tables to
+            # start over from. sqlite3 doesn't open a transaction for DDL by
+            # itself, and executescript() would commit it, so SCHEMA runs
+            # statement by statement.
+            self.conn.execute("BEGIN")
+            for statement in SCHEMA.split(";"):
+                if statement.strip():
+                    self.conn.execute(statement)
+            if legacy_json_path and os.path.exists(legacy_json_path):
+                # Replays snapshot + journal; db.json itself is left as a backup.
+                legacy = JsonStore(legacy_json_path)
+                legacy.close()
+                for video in legacy.videos:
+                    _insert_video(self.conn, video)
+                logging.info(f"Migrated {len(legacy.videos)} videos from {legacy_json_path} into {self.path}")
+            self.conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    # --- Indexes ---
+    @property
+    def list_view(self):
+        self._ensure_indexes()
+        return self._list_view
+
+    def _ensure_indexes(self):
+        if self._list_view is not None:
+            return
+        self._list_view = ListView()
+        self._by_key = {}
+        self._by_id = {}
+        # Not through _index, which would count the videos again in a tag
+        # dictionary that is already built.
+        for row in self.conn.execute(f"SELECT {VIDEO_COLUMNS} FROM videos ORDER BY id"):
+            video = _row_to_video(row, self.tag_table)
+            self._list_view.add(video)
+            self._by_key.setdefault(video.key, video)
+            self._by_id[video.id] = video
+
+    # --- Reads ---
+    def count(self):
+        return self._count
+
+    def _row_at(self, index):
+        if index < 0:
+            return None
+        return self.conn.execute(
+            f"SELECT {VIDEO_COLUMNS} FROM videos ORDER BY id LIMIT 1 OFFSET ?", (index,)
+        ).fetchone()
+
+    def get(self, index):
+        if self._by_id is not None:
+            if not 0 <= index < len(self._by_id):
+                return None
+            return next(itertools.islice(self._by_id.values(), index, None))
+        row = self._row_at(index)
+        return _row_to_video(row, self.tag_table) if row else None
+
+    def find(self, video_id):
+        self._ensure_indexes()
+        return self._by_id.get(video_id)
+
+    def complete_tags(self, prefix, limit=10):
+        if self._tag_dictionary is None:
+            if self._by_id is not None:
+                # Mutations may not be committed yet; memory has them all.
+                counts = Counter(tag for video in self._by_id.values() for tag in video.tag_names)
+            else:
+                # Nothing changed since the store was opened.
+                counts = dict(self.conn.execute(
+                    "SELECT tags.name, COUNT(*) FROM video_tags JOIN tags ON tags.id = video_tags.tag_id "
+                    "GROUP BY video_tags.tag_id"
+                ))
+            self._tag_dictionary = TagDictionary(counts)
+        return self._tag_dictionary.complete(prefix, limit)
+
+    def all(self):
+        if self._by_id is not None:
+            return iter(list(self._by_id.values()))
+        return (_row_to_video(row, self.tag_table)
+                for row in self.conn.execute(f"SELECT {VIDEO_COLUMNS} FROM videos ORDER BY id"))
+
+    def search(self, query, start=0):
+        key = format_query(query)
+        ids = self._search_cache.get(key)
+        if ids is None:
+            generation = self._generation
+            ids = evaluate(query, self.tag_index)
+            if self._committed == generation:
+                self._search_cache.put(key, ids)
+        return self._videos_by_id(ids, start)
+
+    def _videos_by_id(self, ids, start):
+        for i in range(start, len(ids), SQL_CHUNK_SIZE):
+            chunk = ids[i:i + SQL_CHUNK_SIZE]
+            rows = self.conn.execute(
+                f"SELECT {VIDEO_COLUMNS} FROM videos WHERE id IN ({', '.join('?' * len(chunk))})", chunk
+            )
+            by_id = {row[0]: row for row in rows}
+            for video_id in chunk:
+                if video_id in by_id:
+                    yield _row_to_video(by_id[video_id], self.tag_table)
+
+    # --- Mutations ---
+    # Versions are checked against _by_id rather than the database, which
+    # may not have the latest writes committed yet.
+    def _assign_id(self, video):
+        video.id = video.slot = self._next_id
+        video.version = 1
+        self._next_id += 1
+
+    def _insert(self, video):
+        self._assign_id(video)
+        self._index(video)
+        self._count += 1
+        self._submit(lambda conn: _insert_video(conn, video, video.slot))
+
+    def _insert_many(self, videos):
+        for video in videos:
+            self._assign_id(video)
+            self._index(video)
+        self._count += len(videos)
+
+        def insert_all(conn):
+            for video in videos:
+                _insert_video(conn, video, video.slot)
+        self._submit(insert_all)
+
+    def _merge(self, existing, hashtags):
+        extra = extra_hashtags(existing, hashtags)
+        if extra:
+            self._replace_slot(existing, existing.with_hashtags(extra))
+
+    def _index(self, video):
+        self._list_view.add(video)
+        self._by_key.setdefault(video.key, video)
+        self._by_id[video.id] = video
+        if self._tag_dictionary is not None:
+            self._tag_dictionary.add(video.tag_names)
+        self._search_cache.clear()
+
+    def _unindex(self, video):
+        # Leaves _by_id to the caller, so an edit keeps the video's place.
+        self._list_view.remove(video)
+        if self._by_key.get(video.key) is video:
+            del self._by_key[video.key]
+        if self._tag_dictionary is not None:
+            self._tag_dictionary.remove(video.tag_names)
+        self._search_cache.clear()
+
+    def replace(self, video_id, video, expected_version=None):
+        self._ensure_indexes()
+        old_video = self._by_id.get(video_id)
+        check_version(old_video, video_id, expected_version)
+        return self._replace_slot(old_video, as_video(video, self.tag_table))
+
+    def _replace_slot(self, old_video, video):
+        video.id = video.slot = old_video.slot
+        video.version = old_video.version + 1
+        self._unindex(old_video)
+        self._index(video)
+        return self._submit(lambda conn: _update_video(conn, video.slot, video))
+
+    def delete(self, video_id, expected_version=None):
+        self._ensure_indexes()
+        removed = self._by_id.get(video_id)
+        check_version(removed, video_id, expected_version)
+        self._unindex(removed)
+        del self._by_id[video_id]
+        self._count -= 1
+        self._submit(lambda conn: _delete_video(conn, video_id))
+        return removed
+
+    def set_metadata(self, key, metadata):
+        self._ensure_indexes()
+        video = self._by_key.get(key)
+        if video is None:
+            return None
+        video.title = title = metadata.get("title")
+        video.author = author = metadata.get("author")
+        self._list_view.touch(video)
+        return self._submit(lambda conn: _update_metadata(conn, video.id, title, author))
+
+    def _submit(self, op):
+        self._generation += 1
+        generation = self._generation
+        self._last_write = self._writer.submit(op)
+        self._last_write.add_done_callback(lambda _: setattr(self, "_committed", generation))
+        return self._last_write
+
+    async def flushed(self):
+        if self._last_write is not None:
+            await asyncio.wrap_future(self._last_write)
+
+    def close(self):
+        self._writer.stop()
+        self.conn.close()
+
+
+class SqliteWriter(GroupCommitWriter):
+    def __init__(self, path):
+        super().__init__(name="sqlite-writer")
+        self.path = path
+        self.conn = None
+
+    def open(self):
+        self.conn = _connect(self.path)
+
+    def write(self, op):
+        op(self.conn)
+
+    def sync(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        self.conn.close()
+
+
+# === Per-chat shards ===
+# Each chat's videos live in their own store file under data_dir, so one busy
+# chat never contends with another for a file, a lock or a writer thread.
+# Shards are opened on first access and kept in LRU order; once more than
+# max_shards are open, or the open shards hold more than max_videos videos
+# between them, the least recently used ones are closed. Closing drains the
+# shard's writer on a background thread; reopening a shard waits for that, so
+# callers on the event loop await wait_closed(chat_id) first, which does the
+# waiting on a worker thread.
+#
+# lock(chat_id) is the chat's ChatLock. Whoever holds it has the chat to
+# itself (the bot holds it for the whole of each update, see updates.py). A
+# shard whose lock is held or waited for is never evicted, and its lock is
+# never dropped.
+#
+# set_metadata(chat_id, ...) is for background writes (see enrich.py): it
+# doesn't count as a use of the chat, so it never reloads an evicted shard or
+# moves one up the LRU order. Metadata for a chat that isn't loaded is kept
+# until the chat's shard is next opened.
+MAX_OPEN_SHARDS = 64
+MAX_RESIDENT_VIDEOS = 200_000
+MAX_IDLE_LOCKS = 10_000
+MAX_PENDING_METADATA = 10_000
+
+
+class ChatLock:
+    # An asyncio.Lock used with "async with" that counts the tasks holding or
+    # waiting for it. Lock.locked() is False between release() and the woken
+    # waiter taking the lock; users is not, so a chat with updates queued up
+    # can't look idle in that gap.
+    __slots__ = ("_lock", "users")
+
+    def __init__(self):
+        self._lock = asyncio.Lock()
+        self.users = 0
+
+    async def __aenter__(self):
+        self.users += 1
+        try:
+            await self._lock.acquire()
+        except BaseException:
+            self.users -= 1
+            raise
+
+    async def __aexit__(self, *exc_info):
+        self._lock.release()
+        self.users -= 1
+
+
+class ShardedStore:
+    def __init__(self, backend, data_dir, max_shards=MAX_OPEN_SHARDS,
+                 max_videos=MAX_RESIDENT_VIDEOS, legacy_chat_id=None, legacy_paths=None):
+        self.backend = backend
+        self.data_dir = data_dir
+        self.max_shards = max_shards
+        self.max_videos = max_videos
+        self.legacy_chat_id = legacy_chat_id
+        self.legacy_paths = legacy_paths
+        self._shards = OrderedDict()
+        self._closing = {}
+        self._locks = {}
+        self._pending_metadata = OrderedDict()
+        os.makedirs(data_dir, exist_ok=True)
+
+        if legacy_chat_id is None and legacy_paths and self._legacy_exists():
+            logging.warning("Videos saved before per-chat storage are not served; set LEGACY_CHAT_ID to adopt them")
+
+    def path_for(self, chat_id):
+        return os.path.join(self.data_dir, f"{chat_id}{STORE_SUFFIXES[self.backend]}")
+
+    def get(self, chat_id):
+        shard = self._shards.pop(chat_id, None)
+        if shard is None:
+            shard = self._open(chat_id)
+        self._shards[chat_id] = shard
+        self._evict()
+        return shard
+
+    def _open(self, chat_id):
+        closing = self._closing.pop(chat_id, None)
+        if closing:
+            # Already finished if the caller awaited wait_closed().
+            closing.join()
+        path = self.path_for(chat_id)
+        is_new = not os.path.exists(path)
+        shard = open_store(self.backend, path)
+        if is_new and chat_id == self.legacy_chat_id:
+            self._adopt_legacy(shard)
+        for key, metadata in self._pending_metadata.pop(chat_id, {}).items():
+            shard.set_metadata(key, metadata)
+        return shard
+
+    async def wait_closed(self, chat_id):
+        closing = self._closing.get(chat_id)
+        if closing is not None:
+            await asyncio.to_thread(closing.join)
+
+    def set_metadata(self, chat_id, key, metadata):
+        shard = self._shards.get(chat_id)
+        if shard is not None:
+            return shard.set_metadata(key, metadata)
+        pending = self._pending_metadata.setdefault(chat_id, {})
+        pending[key] = metadata
+        while len(self._pending_metadata) > MAX_PENDING_METADATA:
+            self._pending_metadata.popitem(last=False)
+        return None
+
+    def exists(self, chat_id):
+        return chat_id in self._shards or os.path.exists(self.path_for(chat_id))
+
+    def lock(self, chat_id):
+        lock = self._locks.get(chat_id)
+        if lock is None:
+            if len(self._locks) > MAX_IDLE_LOCKS:
+                # Chats that never opened their shard keep a lock until here.
+                for idle in [c for c, l in self._locks.items() if c not in self._shards and not l.users]:
+                    del self._locks[idle]
+            lock = self._locks[chat_id] = ChatLock()
+        return lock
+
+    def _in_use(self, chat_id):
+        lock = self._locks.get(chat_id)
+        return lock is not None and lock.users > 0
+
+    def resident_videos(self):
+        return sum(shard.count() for shard in self._shards.values())
+
+    def open_shards(self):
+        return len(self._shards)
+
+    def _evict(self):
+        resident = self.resident_videos()
+        # Never the shard just handed out, which is last.
+        candidates = [chat_id for chat_id in list(self._shards)[:-1] if not self._in_use(chat_id)]
+        for chat_id in candidates:
+            if len(self._shards) <= self.max_shards and resident <= self.max_videos:
+                break
+            shard = self._shards.pop(chat_id)
+            self._locks.pop(chat_id, None)
+            resident -= shard.count()
+            closing = threading.Thread(target=shard.close, name=f"close-shard-{chat_id}", daemon=True)
+            closing.start()
+            self._closing[chat_id] = closing
+        for chat_id, closing in list(self._closing.items()):
+            if not closing.is_alive():
+                del self._closing[chat_id]
+
+    # --- Collection from before per-chat storage ---
+    def _legacy_exists(self):
+        json_path, sqlite_path = self.legacy_paths
+        return os.path.exists(json_path) or os.path.exists(sqlite_path)
+
+    def _adopt_legacy(self, shard):
+        if not self.legacy_paths or not self._legacy_exists():
+            return
+        json_path, sqlite_path = self.legacy_paths
+        if self.backend == "json":
+            legacy = JsonStore(json_path)
+        else:
+            legacy = SqliteStore(sqlite_path, legacy_json_path=json_path)
+        shard.add_many(legacy.all())
+        legacy.close()
+        if shard._last_write is not None:
+            # The legacy files stay as a backup, but wait until the shard has
+            # the videos for good before the chat goes on to change them.
+            shard._last_write.result()
+        logging.info(f"Moved {shard.count()} legacy videos into chat {self.legacy_chat_id}")
+
+    def close(self):
+        while self._shards:
+            _, shard = self._shards.popitem()
+            shard.close()
+        for closing in self._closing.values():
+            closing.join()
+        self._closing.clear()
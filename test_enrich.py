@@ -0,0 +1,156 @@
+import asyncio
+import socket
+from collections import Counter
+import pytest
+from aiohttp import web
+from aiohttp.abc import AbstractResolver
+import enrich
+from enrich import Enricher, PublicResolver
+
+# The enrichment pipeline against a local stub server. Every host name
+# resolves to the stub, so a short link (vm.tiktok.com/..., xhslink.com/...)
+# can redirect to a real video URL (www.tiktok.com/@user/video/<id>) without
+# leaving the machine.
+
+
+class LocalResolver(AbstractResolver):
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        return [{"hostname": host, "host": "127.0.0.1", "port": port,
+                 "family": socket.AF_INET, "proto": 0, "flags": socket.AI_NUMERICHOST}]
+
+    async def close(self):
+        pass
+
+
+class Stub:
+    def __init__(self):
+        self.hits = Counter()
+        self.failures = Counter()
+        self.oembed_urls = []
+        self.port = None
+        app = web.Application()
+        app.router.add_get("/oembed", self.oembed)
+        app.router.add_get("/{path:.*}", self.page)
+        self.runner = web.AppRunner(app)
+
+    async def __aenter__(self):
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = self.runner.addresses[0][1]
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.runner.cleanup()
+
+    def url(self, path, host="127.0.0.1"):
+        return f"http://{host}:{self.port}{path}"
+
+    async def oembed(self, request):
+        self.hits["/oembed"] += 1
+        self.oembed_urls.append(request.query["url"])
+        return web.json_response({"title": "Best hotpot in GZ", "author_name": "foodie"})
+
+    async def page(self, request):
+        path = request.path
+        self.hits[path] += 1
+        if path == "/s/abc":
+            raise web.HTTPFound(self.url("/@foodie/video/7123456789", host="www.tiktok.com"))
+        if path == "/s/local":
+            raise web.HTTPFound(self.url("/article"))
+        if path == "/flaky" and self.failures[path] < 2:
+            self.failures[path] += 1
+            return web.Response(status=503, headers={"Retry-After": "0"})
+        if path in ("/article", "/flaky"):
+            return web.Response(
+                text='<html><head><meta property="og:title" content="Canton Tower at night">'
+                     '<meta property="og:site_name" content="Travel Blog"></head></html>',
+                content_type="text/html",
+            )
+        return web.Response(status=404)
+
+
+def run(test):
+    async def main():
+        async with Stub() as stub:
+            enricher = Enricher(lambda *args: None, endpoints={"tiktok": stub.url("/oembed")}, resolver=LocalResolver())
+            await enricher.start()
+            try:
+                await test(stub, enricher)
+            finally:
+                await enricher.close()
+    asyncio.run(main())
+
+
+def test_page_is_fetched_once():
+    async def test(stub, enricher):
+        metadata = await enricher.lookup(stub.url("/article", host="xhslink.com"))
+        assert metadata == {"title": "Canton Tower at night", "author": "Travel Blog"}
+        assert stub.hits["/article"] == 1
+    run(test)
+
+
+def test_short_link_is_looked_up_through_oembed():
+    async def test(stub, enricher):
+        metadata = await enricher.lookup(stub.url("/s/abc", host="vm.tiktok.com"))
+        assert metadata == {"title": "Best hotpot in GZ", "author": "foodie"}
+        assert stub.hits["/s/abc"] == 1
+        assert stub.oembed_urls == [stub.url("/@foodie/video/7123456789", host="www.tiktok.com")]
+    run(test)
+
+
+def test_retries_server_errors(monkeypatch):
+    monkeypatch.setattr(enrich, "BACKOFF_BASE", 0)
+
+    async def test(stub, enricher):
+        metadata = await enricher.lookup(stub.url("/flaky", host="xhslink.com"))
+        assert metadata["title"] == "Canton Tower at night"
+        assert stub.hits["/flaky"] == 3
+    run(test)
+
+
+def test_missing_pages_are_cached():
+    async def test(stub, enricher):
+        assert await enricher.lookup(stub.url("/gone", host="xhslink.com")) is None
+        assert await enricher.lookup(stub.url("/gone", host="xhslink.com")) is None
+        assert stub.hits["/gone"] == 1
+    run(test)
+
+
+def test_workers_store_metadata():
+    async def main():
+        async with Stub() as stub:
+            stored = asyncio.Queue()
+            enricher = Enricher(lambda *args: stored.put_nowait(args), endpoints={}, resolver=LocalResolver())
+            await enricher.start()
+            try:
+                enricher.submit(42, stub.url("/article", host="xhslink.com"))
+                chat_id, key, metadata = await asyncio.wait_for(stored.get(), 5)
+            finally:
+                await enricher.close()
+            assert (chat_id, key) == (42, "xhslink.com/article")
+            assert metadata["title"] == "Canton Tower at night"
+    asyncio.run(main())
+
+
+def test_other_sites_are_not_fetched():
+    async def test(stub, enricher):
+        assert await enricher.lookup(stub.url("/article", host="example.com")) is None
+        assert await enricher.lookup(stub.url("/article")) is None
+        assert stub.hits["/article"] == 0
+    run(test)
+
+
+def test_redirects_to_private_addresses_are_refused():
+    async def test(stub, enricher):
+        assert await enricher.lookup(stub.url("/s/local", host="xhslink.com")) is None
+        assert stub.hits["/s/local"] == 1
+        assert stub.hits["/article"] == 0
+    run(test)
+
+
+def test_public_resolver_drops_private_addresses():
+    async def main():
+        with pytest.raises(OSError):
+            await PublicResolver(LocalResolver()).resolve("xhslink.com", 80)
+    asyncio.run(main())
@@ -0,0 +1,133 @@
+import asyncio
+import random
+import pytest
+import storage
+from query import And, Not, Or, Prefix, QueryError, Tag, format_query, parse_query
+
+# The query planner against a brute-force match over every video, on both
+# backends, and the /list view's paging.
+
+TAGS = ["#gz", "#sz", "#toeat", "#toexplore", "#tobuy", "#hotpot", "#dimsum", "#tea", "#tower", "#closed"]
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def store(request, tmp_path):
+    path = str(tmp_path / ("chat.json" if request.param == "json" else "chat.db"))
+    store = storage.open_store(request.param, path)
+    yield store
+    store.close()
+
+
+def fill(store, rng, count):
+    for n in range(count):
+        tags = rng.sample(TAGS, rng.randrange(4))
+        tags = [tag.upper() if rng.random() < 0.1 else tag for tag in tags]
+        store.add({"url": f"https://www.tiktok.com/@user/video/{n}", "hashtags": tags})
+    # Edits and deletes, so slots and ids have gaps and moved videos.
+    for video in rng.sample(list(store.all()), count // 5):
+        if rng.random() < 0.5:
+            store.delete(video.id)
+        else:
+            store.replace(video.id, {"url": video.url, "hashtags": rng.sample(TAGS, rng.randrange(4))})
+    # SqliteStore searches what its writer has committed.
+    asyncio.run(store.flushed())
+
+
+def random_query(rng, depth=0):
+    kind = rng.randrange(6) if depth < 3 else 0
+    if kind in (0, 1):
+        return rng.choice(TAGS + ["#missing"])
+    if kind == 2:
+        return rng.choice(["#to", "#t", "#d", "#x"]) + "*"
+    if kind == 3:
+        return "-" + random_query(rng, depth + 1)
+    joiner = " " if kind == 4 else " OR "
+    return "(" + joiner.join(random_query(rng, depth + 1) for _ in range(rng.randrange(2, 4))) + ")"
+
+
+def matches(node, tags):
+    if isinstance(node, Tag):
+        return node.name in tags
+    if isinstance(node, Prefix):
+        return any(tag.startswith(node.prefix) for tag in tags)
+    if isinstance(node, Not):
+        return not matches(node.child, tags)
+    if isinstance(node, And):
+        return all(matches(child, tags) for child in node.children)
+    return any(matches(child, tags) for child in node.children)
+
+
+# === Parsing ===
+def test_equivalent_queries_format_the_same():
+    assert format_query(parse_query("#B #a")) == format_query(parse_query("#a AND #b")) == "#a #b"
+    assert format_query(parse_query("- -#gz")) == "#gz"
+    assert format_query(parse_query("#a OR (#b OR #a)")) == "#a OR #b"
+    assert format_query(parse_query("-(#b #a) #c")) == "#c -(#a #b)"
+
+
+@pytest.mark.parametrize("text", ["", "(#gz", "#gz)", "gz", "#gz OR", "AND #gz", " ".join(["#t"] * 33)])
+def test_invalid_queries_are_rejected(text):
+    with pytest.raises(QueryError):
+        parse_query(text)
+
+
+# === Planner ===
+def test_search_matches_brute_force(store):
+    rng = random.Random(7)
+    fill(store, rng, 300)
+    videos = list(store.all())
+    for _ in range(300):
+        query = parse_query(random_query(rng))
+        expected = [video.id for video in videos if matches(query, set(video.tag_names))]
+        assert [video.id for video in store.search(query)] == expected, format_query(query)
+        # Served from the result cache the second time.
+        assert [video.id for video in store.search(query, start=1)] == expected[1:]
+
+
+def test_search_cache_is_cleared_by_writes(store):
+    store.add({"url": "https://www.tiktok.com/@user/video/1", "hashtags": ["#gz"]})
+    asyncio.run(store.flushed())
+    query = parse_query("#gz")
+    assert len(list(store.search(query))) == 1
+    store.add({"url": "https://www.tiktok.com/@user/video/2", "hashtags": ["#gz"]})
+    asyncio.run(store.flushed())
+    assert len(list(store.search(query))) == 2
+
+
+# === /list paging ===
+def expected_headers(lines, start):
+    # The City/Category/Tags lines open above `start`, by walking the lines:
+    # every blank line closes the innermost open heading.
+    open_headers = []
+    for line in lines[:start]:
+        if line.startswith("City: "):
+            open_headers = [line]
+        elif line.startswith("  Category: "):
+            open_headers = open_headers[:1] + [line]
+        elif line.startswith("    Tags: "):
+            open_headers = open_headers[:2] + [line]
+        elif not line:
+            open_headers.pop()
+    # A page starting on a group's closing blank line doesn't repeat its Tags.
+    if start < len(lines) and not lines[start] and len(open_headers) == 3:
+        open_headers.pop()
+    return open_headers
+
+
+def test_list_pages_resume_with_their_headers(store):
+    rng = random.Random(3)
+    fill(store, rng, 120)
+    view = store.list_view
+    lines = list(view.iter_lines())
+    for start in range(len(lines) + 2):
+        assert list(view.iter_lines(start)) == lines[start:]
+        assert view.headers_at(start) == expected_headers(lines, start), start
+
+
+def test_list_view_follows_writes(store):
+    rng = random.Random(5)
+    fill(store, rng, 80)
+    rebuilt = storage.ListView()
+    for video in store.all():
+        rebuilt.add(video)
+    assert store.list_view.render() == rebuilt.render()
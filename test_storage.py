@@ -0,0 +1,197 @@
+import json
+import os
+import shutil
+import sqlite3
+import pytest
+import storage
+from storage import JsonStore, SqliteStore, VersionConflict, canonical_url
+
+# Both backends through the store interface, plus the JSON backend's journal
+# recovery and the SQLite backend's schema setup.
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def open_store(request, tmp_path):
+    path = str(tmp_path / ("chat.json" if request.param == "json" else "chat.db"))
+    stores = []
+
+    def open_():
+        store = storage.open_store(request.param, path)
+        stores.append(store)
+        return store
+    yield open_
+    for store in stores:
+        store.close()
+
+
+def video(n, *hashtags):
+    return {"url": f"https://www.tiktok.com/@user/video/{n}", "hashtags": list(hashtags)}
+
+
+def snapshot(store):
+    return [(v.id, v.version, v.url, v.hashtags) for v in store.all()]
+
+
+# === Canonical URLs and duplicates ===
+def test_unparseable_urls_are_their_own_key():
+    assert canonical_url("  http://[oops ") == "http://[oops"
+
+
+def test_unparseable_urls_are_stored(open_store):
+    store = open_store()
+    assert store.add({"url": "http://[oops", "hashtags": ["#gz"]})
+    assert store.add_many([{"url": "http://[oops", "hashtags": ["#food"]}]) == (0, 1)
+    store.close()
+    assert [video.hashtags for video in open_store().all()] == [("#gz", "#food")]
+
+
+def test_same_video_is_merged(open_store):
+    store = open_store()
+    assert store.add({"url": "https://www.tiktok.com/@a/video/123?is_from_webapp=1", "hashtags": ["#gz"]})
+    assert not store.add({"url": "https://m.tiktok.com/v/123", "hashtags": ["#GZ", "#food"]})
+    assert store.count() == 1
+    assert store.get(0).hashtags == ("#gz", "#food")
+    assert store.get(0).version == 2
+
+
+def test_add_many_merges_within_the_batch_and_with_stored_videos(open_store):
+    store = open_store()
+    store.add(video(1, "#gz"))
+    assert store.add_many([video(1, "#food"), video(2, "#sz"), video(2, "#tobuy")]) == (1, 2)
+    assert [v.hashtags for v in store.all()] == [("#gz", "#food"), ("#sz", "#tobuy")]
+    store.close()
+    assert [v.hashtags for v in open_store().all()] == [("#gz", "#food"), ("#sz", "#tobuy")]
+
+
+# === Versions ===
+def test_stale_edits_and_deletes_conflict(open_store):
+    store = open_store()
+    store.add(video(1, "#gz"))
+    first = store.get(0)
+    store.replace(first.id, video(2, "#sz"), expected_version=first.version)
+    with pytest.raises(VersionConflict):
+        store.replace(first.id, video(3, "#gz"), expected_version=first.version)
+    with pytest.raises(VersionConflict):
+        store.delete(first.id, expected_version=first.version)
+    store.delete(first.id, expected_version=first.version + 1)
+    with pytest.raises(VersionConflict):
+        store.delete(first.id)
+    with pytest.raises(VersionConflict):
+        store.replace(first.id, video(3, "#gz"))
+
+
+def test_ids_are_never_reused(open_store):
+    store = open_store()
+    store.add_many([video(1), video(2)])
+    store.delete(2)
+    store.close()
+    store = open_store()
+    store.add(video(3))
+    assert [v.id for v in store.all()] == [1, 3]
+
+
+# === JSON journal ===
+def json_store(tmp_path, **kwargs):
+    return JsonStore(str(tmp_path / "chat.json"), **kwargs)
+
+
+def test_torn_journal_record_is_dropped(tmp_path):
+    store = json_store(tmp_path)
+    store.add_many([video(1, "#gz"), video(2, "#sz")])
+    store.close()
+    size = os.path.getsize(store.journal_path)
+    with open(store.journal_path, "ab") as f:
+        f.write(b'{"op": "add", "vid')
+
+    store = json_store(tmp_path)
+    assert [v.id for v in store.all()] == [1, 2]
+    assert os.path.getsize(store.journal_path) == size
+    store.add(video(3, "#toeat"))
+    store.close()
+    assert [v.id for v in json_store(tmp_path).all()] == [1, 2, 3]
+
+
+def test_rotated_journal_is_replayed(tmp_path, monkeypatch):
+    # A crash between rotating the journal and writing the snapshot leaves
+    # journal.old next to a new journal and an older snapshot.
+    monkeypatch.setattr(JsonStore, "_compact", lambda self, videos, seq, next_id: None)
+    store = json_store(tmp_path)
+    store.add_many([video(1, "#gz"), video(2, "#sz")])
+    store.compact()
+    store.replace(1, video(1, "#gz", "#food"))
+    store.close()
+    assert os.path.exists(store.journal_path + ".old")
+    expected = snapshot(store)
+
+    monkeypatch.undo()
+    store = json_store(tmp_path)
+    assert snapshot(store) == expected
+    # Folded into the snapshot straight away.
+    assert not os.path.exists(store.journal_path + ".old")
+    store.close()
+    assert snapshot(json_store(tmp_path)) == expected
+
+
+def test_records_in_the_snapshot_are_not_replayed_twice(tmp_path):
+    store = json_store(tmp_path)
+    store.add_many([video(1, "#gz"), video(2, "#sz")])
+    store.close()
+    shutil.copy(store.journal_path, str(tmp_path / "journal.copy"))
+    store = json_store(tmp_path)
+    store.compact()
+    store.close()
+    # The snapshot was written but journal.old not yet removed.
+    shutil.copy(str(tmp_path / "journal.copy"), store.journal_path + ".old")
+    assert [v.id for v in json_store(tmp_path).all()] == [1, 2]
+
+
+def test_compaction_rotates_the_journal(tmp_path):
+    store = json_store(tmp_path, compact_every=5)
+    for n in range(12):
+        store.add(video(n, f"#tag{n}"))
+    store.delete(3)
+    store.close()
+    expected = snapshot(store)
+    with open(store.journal_path, "rb") as f:
+        assert len(f.readlines()) < 5
+    assert not os.path.exists(store.journal_path + ".old")
+    assert snapshot(json_store(tmp_path)) == expected
+
+
+def test_legacy_json_snapshot_loads(tmp_path):
+    path = tmp_path / "chat.json"
+    path.write_text(json.dumps({"videos": [video(1, "#gz"), video(2, "#sz")]}))
+    store = json_store(tmp_path)
+    assert [(v.id, v.hashtags) for v in store.all()] == [(1, ("#gz",)), (2, ("#sz",))]
+    store.compact()
+    store.close()
+    with open(path, "rb") as f:
+        assert f.read(4) == storage.SNAPSHOT_MAGIC
+    assert [v.id for v in json_store(tmp_path).all()] == [1, 2]
+
+
+# === SQLite schema ===
+def test_sqlite_imports_db_json_once(tmp_path):
+    legacy = tmp_path / "db.json"
+    legacy.write_text(json.dumps({"videos": [video(1, "#gz"), video(2, "#sz")]}))
+    path = str(tmp_path / "videos.db")
+    store = SqliteStore(path, legacy_json_path=str(legacy))
+    assert [(v.id, v.key, v.hashtags) for v in store.all()] == [(1, "tiktok:1", ("#gz",)), (2, "tiktok:2", ("#sz",))]
+    store.add(video(3, "#toeat"))
+    store.close()
+
+    store = SqliteStore(path, legacy_json_path=str(legacy))
+    assert [v.id for v in store.all()] == [1, 2, 3]
+    store.close()
+    conn = sqlite3.connect(path)
+    assert conn.execute("PRAGMA user_version").fetchone() == (storage.SCHEMA_VERSION,)
+    conn.close()
+
+
+def test_sqlite_reads_see_uncommitted_writes(tmp_path):
+    store = SqliteStore(str(tmp_path / "videos.db"))
+    store.add(video(1, "#gz"))
+    store.replace(1, video(1, "#sz"))
+    assert store.get(0).hashtags == ("#sz",)
+    assert [v.hashtags for v in store.all()] == [("#sz",)]
+    store.close()
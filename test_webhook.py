@@ -0,0 +1,79 @@
+import asyncio
+import json
+from types import SimpleNamespace
+from aiohttp.test_utils import TestClient, TestServer
+from telegram import Bot
+import bot
+
+# The webhook endpoint on the bot's aiohttp app, driven through aiohttp's test
+# client. A stand-in for the PTB application is enough: the handler only uses
+# its bot (to build the Update) and its update_queue.
+
+SECRET = "test-secret"
+UPDATE = {
+    "update_id": 1,
+    "message": {"message_id": 5, "date": 0, "chat": {"id": 42, "type": "private"}, "text": "/list"},
+}
+
+
+def run(test, ready=True):
+    async def main():
+        bot_app = asyncio.get_running_loop().create_future()
+        application = SimpleNamespace(bot=Bot("123:abc"), update_queue=asyncio.Queue())
+        if ready:
+            bot_app.set_result(application)
+        client = TestClient(TestServer(bot.build_web_app(bot_app)))
+        await client.start_server()
+        try:
+            await test(client, application)
+        finally:
+            await client.close()
+    asyncio.run(main())
+
+
+def post(client, body, secret=SECRET):
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret, "Content-Type": "application/json"}
+    return client.post(bot.WEBHOOK_PATH, data=body, headers=headers)
+
+
+def test_wrong_secret_is_forbidden(monkeypatch):
+    monkeypatch.setattr(bot, "WEBHOOK_SECRET", SECRET)
+
+    async def test(client, application):
+        response = await post(client, json.dumps(UPDATE), secret="wrong")
+        assert response.status == 403
+        assert application.update_queue.empty()
+    run(test)
+
+
+def test_updates_before_the_bot_is_ready_are_refused(monkeypatch):
+    monkeypatch.setattr(bot, "WEBHOOK_SECRET", SECRET)
+
+    async def test(client, application):
+        response = await post(client, json.dumps(UPDATE))
+        assert response.status == 503
+    run(test, ready=False)
+
+
+def test_malformed_bodies_are_rejected(monkeypatch):
+    monkeypatch.setattr(bot, "WEBHOOK_SECRET", SECRET)
+
+    async def test(client, application):
+        for body in ("not json", "[1, 2]", "{}", '{"update_id": 1, "message": 5}'):
+            response = await post(client, body)
+            assert response.status == 400, body
+        assert application.update_queue.empty()
+    run(test)
+
+
+def test_update_is_queued(monkeypatch):
+    monkeypatch.setattr(bot, "WEBHOOK_SECRET", SECRET)
+
+    async def test(client, application):
+        response = await post(client, json.dumps(UPDATE))
+        assert response.status == 200
+        update = application.update_queue.get_nowait()
+        assert update.update_id == 1
+        assert update.message.text == "/list"
+        assert update.effective_chat.id == 42
+    run(test)
@@ -0,0 +1,51 @@
+import asyncio
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# === Concurrent update processing ===
+# Plugged into the Application with concurrent_updates, so up to
+# max_concurrent_updates updates are handled at once. Updates from different
+# chats run side by side, while each chat's updates run one at a time, in the
+# order they arrived, under that chat's lock (see ShardedStore.lock). That
+# keeps multi-message exchanges like /addvideo followed by the link in order,
+# and the shard can't be evicted while its update is being handled. A shard
+# evicted earlier may still be closing; that is waited for under the lock, off
+# the event loop (see ShardedStore.wait_closed). Updates without a chat, such
+# as inline queries, don't wait for a lock.
+#
+# An update only takes one of the max_concurrent_updates slots once it holds
+# its chat's lock, so a burst from one chat can't starve the others. The slots
+# are this processor's own semaphore: BaseUpdateProcessor takes its semaphore
+# before do_process_update is called, so that one is sized to never fill up.
+#
+# Edits made across updates (/editvideo, then the new link) remember the id
+# and version of the video and fail if it changed in between, so a chat's
+# updates being handled in turn is not what keeps data consistent.
+
+MAX_CONCURRENT_UPDATES = 32
+MAX_WAITING_UPDATES = 1 << 20
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, shards, max_concurrent_updates=MAX_CONCURRENT_UPDATES):
+        super().__init__(MAX_WAITING_UPDATES)
+        self.shards = shards
+        self.limit = max_concurrent_updates
+        self.running = None
+
+    async def initialize(self):
+        self.running = asyncio.Semaphore(self.limit)
+
+    async def shutdown(self):
+        pass
+
+    async def do_process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with self.running:
+                await coroutine
+            return
+        async with self.shards.lock(chat.id):
+            await self.shards.wait_closed(chat.id)
+            async with self.running:
+                await coroutine